@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+#
+# Benchmarks for the heroprotocol decoders.
+#
+# Usage: benchmark.py [--memory] [--cold-start] [--parallel] [--metadata] [--decrypt] [--streaming]
+#                     replay_file
+
+import sys
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+
+from mpyq import mpyq
+import metadata
+import registry
+
+# Median latency in seconds that reading a replay's header and details
+# through metadata.read_metadata should stay under, protocols loaded.
+METADATA_TARGET = 0.005
+
+
+def deep_size(value, seen=None):
+    # Returns the bytes used by value and everything it references.
+    if seen is None:
+        seen = set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict) or hasattr(value, 'iteritems'):
+        for k, v in value.iteritems():
+            size += deep_size(k, seen) + deep_size(v, seen)
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        for v in value:
+            size += deep_size(v, seen)
+    return size
+
+
+def load_protocol(archive):
+    # Returns the protocol module for the replay's base build.
+    contents = archive.header['user_data_header']['content']
+    header = registry.load_protocol(29406).decode_replay_header(contents)
+    baseBuild = header['m_version']['m_baseBuild']
+    return registry.load_protocol(baseBuild)
+
+
+def bench_memory(archive, protocol):
+    # Compares the size of the decoded event streams as dicts and records.
+    streams = [('game', 'replay.game.events', protocol.decode_replay_game_events),
+               ('message', 'replay.message.events', protocol.decode_replay_message_events)]
+    if hasattr(protocol, 'decode_replay_tracker_events'):
+        streams.append(('tracker', 'replay.tracker.events', protocol.decode_replay_tracker_events))
+    print '%-8s %8s %12s %12s %6s %8s %8s' % ('stream', 'events', 'dict bytes', 'record bytes', 'ratio', 'dict s', 'record s')
+    for name, filename, decode in streams:
+        contents = archive.read_file(filename)
+        start = time.time()
+        dicts = list(decode(contents))
+        dict_time = time.time() - start
+        dict_size = deep_size(dicts)
+        del dicts
+        start = time.time()
+        records = list(decode(contents, records=True))
+        record_time = time.time() - start
+        record_size = deep_size(records)
+        print '%-8s %8d %12d %12d %6.2f %8.3f %8.3f' % (name, len(records), dict_size, record_size,
+                                                    float(dict_size) / max(record_size, 1),
+                                                    dict_time, record_time)
+
+
+def time_first_output(command, env):
+    # Returns the seconds until the command writes its first line of output
+    # and until it exits.
+    start = time.time()
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, env=env)
+    process.stdout.readline()
+    first = time.time() - start
+    process.stdout.read()
+    process.wait()
+    return first, time.time() - start
+
+
+def copy_sources(directory):
+    # Copies the Python sources of heroprotocol and mpyq to directory,
+    # leaving out the bytecode compiled next to them.
+    source = os.path.dirname(os.path.abspath(__file__))
+    for folder in ('', 'mpyq'):
+        if folder:
+            os.mkdir(os.path.join(directory, folder))
+        for name in os.listdir(os.path.join(source, folder)):
+            if name.endswith('.py'):
+                shutil.copy(os.path.join(source, folder, name), os.path.join(directory, folder, name))
+
+
+def bench_cold_start(replay_file, runs):
+    # Times fresh heroprotocol.py processes with and without the protocol
+    # cache. They run from a copy of the sources without .pyc files, and
+    # with bytecode writing disabled so none get written, so every run
+    # without the cache compiles what it imports, as a worker on a
+    # read-only install would.
+    sources = tempfile.mkdtemp()
+    cache = tempfile.mkdtemp()
+    try:
+        copy_sources(sources)
+        script = os.path.join(sources, 'heroprotocol.py')
+        print '%-10s %-8s %10s %10s' % ('option', 'cache', 'first s', 'total s')
+        for option in ('--header', '--details'):
+            command = [sys.executable, script, option, replay_file]
+            for cached in (False, True):
+                env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+                env.pop('HEROPROTOCOL_CACHE', None)
+                if cached:
+                    env['HEROPROTOCOL_CACHE'] = cache
+                    time_first_output(command, env)
+                times = sorted(time_first_output(command, env) for i in xrange(runs))
+                first, total = times[len(times) / 2]
+                print '%-10s %-8s %10.4f %10.4f' % (option, 'on' if cached else 'off', first, total)
+    finally:
+        shutil.rmtree(sources)
+        shutil.rmtree(cache)
+
+
+def best_time(function, runs):
+    # Returns the fastest of runs calls of function, in seconds.
+    times = []
+    for i in xrange(runs):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def bench_parallel(archive, protocol, runs):
+    # Times decoding the game events serially and on pools of 1, 2, 4, ...
+    # up to the number of cores, with the pools started and the index built
+    # beforehand.
+    contents = archive.read_file('replay.game.events')
+    start = time.time()
+    index = protocol.index_replay_game_events(contents)
+    print 'index: %d checkpoints in %.3fs' % (len(index), time.time() - start)
+    serial = best_time(lambda: list(protocol.decode_replay_game_events(contents)), runs)
+    print '%-8s %8s %8s' % ('workers', 'seconds', 'speedup')
+    print '%-8s %8.3f %8.2f' % ('serial', serial, 1.0)
+    workers = 1
+    while True:
+        pool = multiprocessing.Pool(workers)
+        try:
+            seconds = best_time(lambda: list(protocol.decode_replay_game_events(contents, index=index,
+                                                                                workers=pool)), runs)
+        finally:
+            pool.terminate()
+        print '%-8d %8.3f %8.2f' % (workers, seconds, serial / seconds)
+        if workers >= multiprocessing.cpu_count():
+            break
+        workers = min(workers * 2, multiprocessing.cpu_count())
+
+
+def median_time(function, runs):
+    # Returns the median of runs calls of function, in seconds.
+    times = []
+    for i in xrange(runs):
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return sorted(times)[len(times) / 2]
+
+
+def bench_metadata(replay_file, runs):
+    # Times reading the header and details through a fully opened archive,
+    # as heroprotocol.py used to, and through metadata.read_metadata, and
+    # checks the latter against METADATA_TARGET.
+    def full_archive():
+        archive = mpyq.MPQArchive(replay_file)
+        protocol = load_protocol(archive)
+        protocol.decode_replay_details(archive.read_file('replay.details'))
+        archive.file.close()
+    metadata.read_metadata(replay_file)  # load the protocols
+    print '%-16s %10s' % ('read', 'median ms')
+    print '%-16s %10.3f' % ('full archive', median_time(full_archive, runs) * 1000)
+    print '%-16s %10.3f' % ('header', median_time(lambda: metadata.read_metadata(replay_file, False), runs) * 1000)
+    seconds = median_time(lambda: metadata.read_metadata(replay_file), runs)
+    print '%-16s %10.3f' % ('header+details', seconds * 1000)
+    print 'target %.3f ms: %s' % (METADATA_TARGET * 1000, 'met' if seconds <= METADATA_TARGET else 'MISSED')
+
+
+def bench_decrypt(archive, runs):
+    # Times decrypting random hash tables of 16 to 4096 entries of 16 bytes,
+    # the work of reading an archive's hash or block table.
+    print '%-8s %10s %12s' % ('entries', 'best ms', 'us/entry')
+    entries = 16
+    while entries <= 4096:
+        data = ''.join(chr(random.randrange(256)) for i in xrange(entries * 16))
+        seconds = best_time(lambda: archive._decrypt(data, 0x12345678), runs)
+        print '%-8d %10.3f %12.3f' % (entries, seconds * 1000, seconds * 1e6 / entries)
+        entries *= 4
+
+
+def bench_streaming(archive, protocol, runs):
+    # Times the first and all game events when the stream is read whole
+    # with read_file and sector by sector with open_file.
+    def first_and_total(open_stream):
+        start = time.time()
+        events = protocol.decode_replay_game_events(open_stream('replay.game.events'))
+        next(events)
+        first = time.time() - start
+        for event in events:
+            pass
+        return first, time.time() - start
+    print '%-10s %10s %10s' % ('read', 'first ms', 'total ms')
+    for name, open_stream in (('read_file', archive.read_file), ('open_file', archive.open_file)):
+        times = sorted(first_and_total(open_stream) for i in xrange(runs))
+        first, total = times[len(times) / 2]
+        print '%-10s %10.3f %10.3f' % (name, first * 1000, total * 1000)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('replay_file', help='.StormReplay file to load')
+    parser.add_argument("--memory", help="compare event memory use of dicts and records",
+                        action="store_true")
+    parser.add_argument("--cold-start", help="time heroprotocol.py --header/--details with and without the protocol cache",
+                        action="store_true")
+    parser.add_argument("--parallel", help="time decoding game events on growing process pools",
+                        action="store_true")
+    parser.add_argument("--metadata", help="time reading the header and details against the latency target",
+                        action="store_true")
+    parser.add_argument("--decrypt", help="time decrypting MPQ tables of 16 to 4096 entries",
+                        action="store_true")
+    parser.add_argument("--streaming", help="time the first and all game events read whole and by sector",
+                        action="store_true")
+    parser.add_argument("--runs", help="runs per timing, the median or best is reported",
+                        type=int, default=10)
+    args = parser.parse_args()
+
+    if args.memory:
+        archive = mpyq.MPQArchive(args.replay_file)
+        bench_memory(archive, load_protocol(archive))
+
+    if args.cold_start:
+        bench_cold_start(args.replay_file, args.runs)
+
+    if args.parallel:
+        archive = mpyq.MPQArchive(args.replay_file)
+        bench_parallel(archive, load_protocol(archive), args.runs)
+
+    if args.metadata:
+        bench_metadata(args.replay_file, args.runs)
+
+    if args.decrypt:
+        bench_decrypt(mpyq.MPQArchive(args.replay_file, listfile=False), args.runs)
+
+    if args.streaming:
+        archive = mpyq.MPQArchive(args.replay_file)
+        bench_streaming(archive, load_protocol(archive), args.runs)
@@ -18,7 +18,11 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
+import array
+import functools
+import mmap
 import struct
+import threading
 
 
 class TruncatedError(Exception):
@@ -29,13 +33,41 @@ class CorruptedError(Exception):
     pass
 
 
+def _byte_data(contents, zero_copy=False):
+    # Contents may be a str, bytearray, memoryview or mmap. Those that
+    # support it are viewed through a memoryview so that they all index as
+    # one character strings and, for zero_copy, slice without copying.
+    # Chunked contents, such as an MPQArchive.open_file file, are joined for
+    # protocol modules that pass them to a decoder whole.
+    if hasattr(contents, 'next'):
+        contents = ''.join(contents)
+    if isinstance(contents, bytearray) or (zero_copy and isinstance(contents, str)):
+        return memoryview(contents)
+    return contents
+
+
+def _view(data, start, size):
+    # Zero-copy slice of buffer contents. Python 2 mmaps only share their
+    # memory through the old buffer interface.
+    if isinstance(data, memoryview):
+        return data[start:start + size]
+    if start >= len(data):
+        return ''
+    if isinstance(data, mmap.mmap):
+        return buffer(data, start, size)
+    return memoryview(data)[start:start + size]
+
+
 class BitPackedBuffer:
-    def __init__(self, contents, endian='big'):
-        self._data = contents or []
+    def __init__(self, contents, endian='big', zero_copy=False):
+        self._data = _byte_data(contents, zero_copy) or []
         self._used = 0
         self._next = None
         self._nextbits = 0
         self._bigendian = (endian == 'big')
+        self._copy = isinstance(self._data, memoryview)
+        # blobs come back as views into the contents when zero_copy is set
+        self.read_blob = self.read_aligned_view if zero_copy else self.read_aligned_bytes
 
     def __str__(self):
         return 'buffer(%02x/%d,[%d]=%s)' % (
@@ -48,6 +80,11 @@ class BitPackedBuffer:
     def used_bits(self):
         return self._used * 8 - self._nextbits
 
+    def seek(self, offset):
+        # moves to a byte offset, such as a recorded event boundary
+        self._used = offset
+        self._nextbits = 0
+
     def byte_align(self):
         self._nextbits = 0
 
@@ -55,11 +92,26 @@ class BitPackedBuffer:
         self.byte_align()
         data = self._data[self._used:self._used + bytes]
         self._used += bytes
+        if len(data) != bytes:
+            raise TruncatedError(self)
+        return data.tobytes() if self._copy else data
+
+    def read_aligned_view(self, bytes):
+        self.byte_align()
+        data = _view(self._data, self._used, bytes)
+        self._used += bytes
         if len(data) != bytes:
             raise TruncatedError(self)
         return data
 
     def read_bits(self, bits):
+        nextbits = self._nextbits
+        if 0 < bits <= nextbits:
+            # small values often fit in the rest of the current byte
+            result = self._next & ((1 << bits) - 1)
+            self._next >>= bits
+            self._nextbits = nextbits - bits
+            return result
         result = 0
         resultbits = 0
         while resultbits != bits:
@@ -83,20 +135,430 @@ class BitPackedBuffer:
     def read_unaligned_bytes(self, bytes):
         return ''.join([chr(self.read_bits(8)) for i in xrange(bytes)])
 
+    def read_bits_array(self, bits, count):
+        # Reads count values of the same width. Whole byte big endian values
+        # starting on a byte boundary are unpacked by one struct call.
+        if count and self._nextbits == 0 and self._bigendian and bits in _array_formats:
+            size = count * (bits >> 3)
+            if self._used + size <= len(self._data):
+                return list(struct.unpack('>%d%s' % (count, _array_formats[bits]),
+                                          self.read_aligned_bytes(size)))
+        read_bits = self.read_bits
+        return [read_bits(bits) for i in xrange(count)]
+
+    def skip_bits(self, bits):
+        if bits <= self._nextbits:
+            if bits:
+                self._next >>= bits
+                self._nextbits -= bits
+            return
+        bits -= self._nextbits
+        used = self._used + (bits >> 3)
+        partial = bits & 7
+        if used + (1 if partial else 0) > len(self._data):
+            self._used = len(self._data)
+            self._nextbits = 0
+            raise TruncatedError(self)
+        if partial:
+            self._next = ord(self._data[used]) >> partial
+            used += 1
+        self._used = used
+        self._nextbits = (8 - partial) if partial else 0
+
+
+class WordBitPackedBuffer(BitPackedBuffer):
+    # Reads the same bit stream as BitPackedBuffer but prefetches whole bytes
+    # eight at a time into an integer word, so a value of any width is cut
+    # out of the word with a few shifts and masks instead of a loop per byte.
+    # The word holds the bytes between _used and _fetched, first byte most
+    # significant for big endian reads and least significant for little.
+    def __init__(self, contents, endian='big', zero_copy=False):
+        BitPackedBuffer.__init__(self, contents, endian, zero_copy)
+        self._next = 0
+        self._word = 0
+        self._wordbits = 0
+        self._fetched = 0
+        self._refill = self._refill_big if self._bigendian else self._refill_little
+        self.read_bits = self._read_bits_big if self._bigendian else self._read_bits_little
+
+    def read_aligned_bytes(self, bytes):
+        self._word = 0
+        self._wordbits = 0
+        self._fetched = self._used + bytes
+        return BitPackedBuffer.read_aligned_bytes(self, bytes)
+
+    def read_aligned_view(self, bytes):
+        self._word = 0
+        self._wordbits = 0
+        self._fetched = self._used + bytes
+        return BitPackedBuffer.read_aligned_view(self, bytes)
+
+    def skip_bits(self, bits):
+        self._word = 0
+        self._wordbits = 0
+        try:
+            BitPackedBuffer.skip_bits(self, bits)
+        finally:
+            self._fetched = self._used
+
+    def seek(self, offset):
+        self._word = 0
+        self._wordbits = 0
+        self._fetched = offset
+        BitPackedBuffer.seek(self, offset)
+
+    def _truncated(self):
+        self._used = len(self._data)
+        self._nextbits = 0
+        self._word = 0
+        self._wordbits = 0
+        raise TruncatedError(self)
+
+    def _refill_big(self, bits):
+        data = self._data
+        while self._wordbits < bits:
+            if self._fetched + 8 <= len(data):
+                self._word = (self._word << 64) | _unpack_big_word(data, self._fetched)[0]
+                self._fetched += 8
+                self._wordbits += 64
+            elif self._fetched < len(data):
+                self._word = (self._word << 8) | ord(data[self._fetched])
+                self._fetched += 1
+                self._wordbits += 8
+            else:
+                self._truncated()
+
+    def _refill_little(self, bits):
+        data = self._data
+        while self._wordbits < bits:
+            if self._fetched + 8 <= len(data):
+                self._word |= _unpack_little_word(data, self._fetched)[0] << self._wordbits
+                self._fetched += 8
+                self._wordbits += 64
+            elif self._fetched < len(data):
+                self._word |= ord(data[self._fetched]) << self._wordbits
+                self._fetched += 1
+                self._wordbits += 8
+            else:
+                self._truncated()
+
+    def _read_bits_big(self, bits):
+        nextbits = self._nextbits
+        if bits <= nextbits:
+            result = self._next & ((1 << bits) - 1)
+            self._next >>= bits
+            self._nextbits = nextbits - bits
+            return result
+        # the rest of the current byte is the high part of the result
+        result = self._next & ((1 << nextbits) - 1)
+        rest = bits - nextbits
+        wholebits = (rest + 7) & ~7
+        if self._wordbits < wholebits:
+            self._refill(wholebits)
+        self._wordbits -= wholebits
+        self._used += wholebits >> 3
+        chunk = self._word >> self._wordbits
+        self._word &= (1 << self._wordbits) - 1
+        partial = rest & 7
+        if partial:
+            # only the low bits of the last byte belong to this value
+            last = chunk & 0xff
+            self._next = last >> partial
+            self._nextbits = 8 - partial
+            return (result << rest) | ((chunk >> 8) << partial) | (last & ((1 << partial) - 1))
+        self._nextbits = 0
+        return (result << rest) | chunk
+
+    def _read_bits_little(self, bits):
+        nextbits = self._nextbits
+        if bits <= nextbits:
+            result = self._next & ((1 << bits) - 1)
+            self._next >>= bits
+            self._nextbits = nextbits - bits
+            return result
+        result = self._next & ((1 << nextbits) - 1)
+        rest = bits - nextbits
+        wholebits = (rest + 7) & ~7
+        if self._wordbits < wholebits:
+            self._refill(wholebits)
+        chunk = self._word & ((1 << wholebits) - 1)
+        self._word >>= wholebits
+        self._wordbits -= wholebits
+        self._used += wholebits >> 3
+        self._next = chunk >> rest
+        self._nextbits = wholebits - rest
+        return result | ((chunk & ((1 << rest) - 1)) << nextbits)
+
+
+_unpack_big_word = struct.Struct('>Q').unpack_from
+_unpack_little_word = struct.Struct('<Q').unpack_from
+_array_formats = {8: 'B', 16: 'H', 32: 'I', 64: 'Q'}
+
+
+class ByteAlignedBuffer:
+    # Offset cursor for the versioned format, where every value starts on a
+    # byte boundary: skip markers, vints, blobs and u8/u32/u64 values. Reads
+    # index or slice the contents directly instead of going through the
+    # bit reader.
+    def __init__(self, contents, zero_copy=False):
+        self._data = _byte_data(contents, zero_copy) or ''
+        self._used = 0
+        self._copy = isinstance(self._data, memoryview)
+        self.read_blob = self.read_aligned_view if zero_copy else self.read_aligned_bytes
+
+    def __str__(self):
+        return 'buffer(00/0,[%d]=%s)' % (
+            self._used, '%02x' % (ord(self._data[self._used]),) if (self._used < len(self._data)) else '--')
+
+    def done(self):
+        return self._used >= len(self._data)
+
+    def used_bits(self):
+        return self._used * 8
+
+    def seek(self, offset):
+        self._used = offset
+
+    def byte_align(self):
+        pass
+
+    def read_aligned_bytes(self, bytes):
+        data = self._data[self._used:self._used + bytes]
+        self._used += bytes
+        if len(data) != bytes:
+            raise TruncatedError(self)
+        return data.tobytes() if self._copy else data
+
+    def read_aligned_view(self, bytes):
+        data = _view(self._data, self._used, bytes)
+        self._used += bytes
+        if len(data) != bytes:
+            raise TruncatedError(self)
+        return data
+
+    read_unaligned_bytes = read_aligned_bytes
+
+    def read_bits(self, bits):
+        # only whole bytes can be read from a byte aligned stream
+        result = 0
+        for i in xrange(bits / 8):
+            result = (result << 8) | self.read_u8()
+        return result
+
+    def read_u8(self):
+        try:
+            value = ord(self._data[self._used])
+        except IndexError:
+            raise TruncatedError(self)
+        self._used += 1
+        return value
+
+    def read_vint(self):
+        data = self._data
+        used = self._used
+        try:
+            b = ord(data[used])
+            negative = b & 1
+            result = (b >> 1) & 0x3f
+            bits = 6
+            while b & 0x80:
+                used += 1
+                b = ord(data[used])
+                result |= (b & 0x7f) << bits
+                bits += 7
+        except IndexError:
+            self._used = len(data)
+            raise TruncatedError(self)
+        self._used = used + 1
+        return -result if negative else result
+
+    def read_vint_array(self, count):
+        # Reads count skip marked vints, the items of an int array, in one
+        # loop instead of an expect_skip and read_vint call per item.
+        data = self._data
+        used = self._used
+        values = []
+        append = values.append
+        try:
+            for i in xrange(count):
+                self._used = used
+                if ord(data[used]) != 9:
+                    self._used = used + 1
+                    raise CorruptedError(self)
+                used += 1
+                self._used = len(data)
+                b = ord(data[used])
+                negative = b & 1
+                result = (b >> 1) & 0x3f
+                bits = 6
+                while b & 0x80:
+                    used += 1
+                    b = ord(data[used])
+                    result |= (b & 0x7f) << bits
+                    bits += 7
+                used += 1
+                append(-result if negative else result)
+        except IndexError:
+            raise TruncatedError(self)
+        self._used = used
+        return values
+
+    def expect_skip(self, expected):
+        try:
+            skip = ord(self._data[self._used])
+        except IndexError:
+            raise TruncatedError(self)
+        self._used += 1
+        if skip != expected:
+            raise CorruptedError(self)
+
+    def skip_instance(self):
+        # Steps over one value. The vints that most struct fields and array
+        # items hold are skipped in place; only other nested values recurse.
+        data = self._data
+        used = self._used
+        try:
+            skip = ord(data[used])
+            used += 1
+            if skip == 9:  # vint
+                while ord(data[used]) & 0x80:
+                    used += 1
+                used += 1
+            elif skip == 5 or skip == 0:  # struct or array
+                self._used = used
+                length = self.read_vint()
+                used = self._used
+                for i in xrange(length):
+                    if skip == 5:  # field tag
+                        while ord(data[used]) & 0x80:
+                            used += 1
+                        used += 1
+                    if ord(data[used]) == 9:
+                        used += 1
+                        while ord(data[used]) & 0x80:
+                            used += 1
+                        used += 1
+                    else:
+                        self._used = used
+                        self.skip_instance()
+                        used = self._used
+            elif skip == 1 or skip == 2:  # bitblob or blob
+                self._used = used
+                length = self.read_vint()
+                self.skip_bytes((length + 7) / 8 if skip == 1 else length)
+                return
+            elif skip == 3:  # choice
+                while ord(data[used]) & 0x80:
+                    used += 1
+                self._used = used + 1
+                self.skip_instance()
+                return
+            elif skip == 4:  # optional
+                exists = ord(data[used]) != 0
+                self._used = used + 1
+                if exists:
+                    self.skip_instance()
+                return
+            elif skip == 6:  # u8
+                used += 1
+            elif skip == 7:  # u32
+                used += 4
+            elif skip == 8:  # u64
+                used += 8
+        except IndexError:
+            self._used = len(data)
+            raise TruncatedError(self)
+        self._used = used
+        if used > len(data):
+            raise TruncatedError(self)
+
+    def skip_vint(self):
+        # read_vint without assembling the value
+        data = self._data
+        used = self._used
+        try:
+            while ord(data[used]) & 0x80:
+                used += 1
+        except IndexError:
+            self._used = len(data)
+            raise TruncatedError(self)
+        self._used = used + 1
+
+    def skip_bytes(self, bytes):
+        # read_aligned_bytes without slicing out the skipped data
+        self._used += bytes
+        if bytes < 0 or self._used > len(self._data):
+            raise TruncatedError(self)
+
 
 class BitPackedDecoder:
-    def __init__(self, contents, typeinfos):
-        self._buffer = BitPackedBuffer(contents)
+    def __init__(self, contents, typeinfos, zero_copy=False, records=False, int_arrays=None,
+                 buffer_class=BitPackedBuffer):
+        self._buffer = buffer_class(contents, zero_copy=zero_copy)
         self._typeinfos = typeinfos
+        self._compiler = get_compiler(BitPackedRecordCompiler if records else BitPackedCompiler, typeinfos,
+                                      int_arrays=int_arrays)
+        self._compiled = self._compiler.compile()
 
     def __str__(self):
         return self._buffer.__str__()
 
-    def instance(self, typeid):
+    def instance(self, typeid, fields=None):
         if typeid >= len(self._typeinfos):
             raise CorruptedError(self)
-        typeinfo = self._typeinfos[typeid]
-        return getattr(self, typeinfo[0])(*typeinfo[1])
+        if fields is None:
+            return self._compiled[typeid](self._buffer)
+        return self._compiler.project(typeid, fields)(self._buffer)
+
+    def skip(self, typeid):
+        if typeid >= len(self._typeinfos):
+            raise CorruptedError(self)
+        self._compiler.skip(typeid)(self._buffer)
+
+    def seek(self, offset):
+        self._buffer.seek(offset)
+
+    def byte_align(self):
+        self._buffer.byte_align()
+
+    def done(self):
+        return self._buffer.done()
+
+    def used_bits(self):
+        return self._buffer.used_bits()
+
+
+class VersionedDecoder:
+    def __init__(self, contents, typeinfos, zero_copy=False, records=False, int_arrays=None, inline=()):
+        # inline lists typeids, such as a stream's event types, whose structs
+        # and the structs within them are compiled to generated straight-line
+        # code. That pays off for long event streams but not for one-off
+        # decodes, which would wait for the code to be generated.
+        self._buffer = ByteAlignedBuffer(contents, zero_copy)
+        self._typeinfos = typeinfos
+        if records:
+            self._compiler = get_compiler(VersionedRecordCompiler, typeinfos, int_arrays=int_arrays)
+        else:
+            self._compiler = get_compiler(VersionedCompiler, typeinfos, int_arrays=int_arrays, inline=inline)
+        self._compiled = self._compiler.compile()
+
+    def __str__(self):
+        return self._buffer.__str__()
+
+    def instance(self, typeid, fields=None):
+        if typeid >= len(self._typeinfos):
+            raise CorruptedError(self)
+        if fields is None:
+            return self._compiled[typeid](self._buffer)
+        return self._compiler.project(typeid, fields)(self._buffer)
+
+    def skip(self, typeid):
+        if typeid >= len(self._typeinfos):
+            raise CorruptedError(self)
+        self._compiler.skip(typeid)(self._buffer)
+
+    def seek(self, offset):
+        self._buffer.seek(offset)
 
     def byte_align(self):
         self._buffer.byte_align()
@@ -107,205 +569,1518 @@ class BitPackedDecoder:
     def used_bits(self):
         return self._buffer.used_bits()
 
+
+class _TypeinfoCompiler:
+    # Turns a protocol's typeinfos into one decode callable per typeid. The
+    # callables take the buffer to read from and have their bounds, fields
+    # and child decoders bound in closures, so decoding does no per-value
+    # typeinfo lookup or getattr dispatch.
+    #
+    # Arrays of ints are read in one batch and returned as lists, or with
+    # int_arrays='array' or 'numpy' as array.array or numpy arrays.
+    #
+    # Compilers are shared between threads by get_compiler. Skips,
+    # projections and int readers are compiled on first use while holding
+    # the compiler's lock, and are only published once complete.
+    def __init__(self, typeinfos, int_arrays=None):
+        self._typeinfos = typeinfos
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._compiled = [None] * len(typeinfos)
+        self._skips = [None] * len(typeinfos)
+        self._projections = {}
+        self._int_values = {}
+        self._int_arrays = int_arrays
+        _int_array_type(int_arrays, (0, 0))  # reject unknown kinds up front
+
+    def compile(self):
+        for typeid in xrange(len(self._typeinfos)):
+            self.instance(typeid)
+        return self._compiled
+
+    def instance(self, typeid):
+        return self._lookup(self._compiled, '', typeid)
+
+    def skip(self, typeid):
+        # Consumes an instance of typeid without building its value.
+        return self._lookup(self._skips, '_skip', typeid)
+
+    def int_value(self, typeid):
+        # Reads the int held by a value of typeid without building the value:
+        # an int, a choice of ints such as SVarUint32 or a struct of one int
+        # such as the replay userid. Choices and structs read as the int of
+        # the variant or field present, or 0 when there is none.
+        reader = self._int_values.get(typeid)
+        if reader is None:
+            with self._lock:
+                reader = self._int_value(typeid)
+        return reader
+
+    def _int_value(self, typeid):
+        reader = self._int_values.get(typeid)
+        if reader is None:
+            kind, args = self._typeinfos[typeid]
+            if kind == '_int':
+                reader = self.instance(typeid)
+            elif kind == '_choice' and all(self._typeinfos[f[1]][0] == '_int' for f in args[1].itervalues()):
+                reader = self._int_choice(args[0], dict(
+                    (tag, self.instance(f[1])) for tag, f in args[1].iteritems()))
+            elif kind == '_struct' and len(args[0]) == 1 and self._typeinfos[args[0][0][1]][0] == '_int':
+                reader = self._int_struct(args[0][0][2], self.instance(args[0][0][1]))
+            else:
+                raise ValueError('int_value(%d)' % typeid)
+            self._int_values[typeid] = reader
+        return reader
+
+    def project(self, typeid, fields):
+        # Decodes only the given dotted field paths of typeid, for example
+        # 'm_abil.m_abilLink'. Other fields are skipped without being built.
+        # A single path string or a path that names no field is a ValueError
+        # rather than a projection that silently decodes nothing.
+        if isinstance(fields, basestring):
+            raise ValueError('fields(%r)' % (fields,))
+        key = (typeid, frozenset(fields))
+        projected = self._projections.get(key)
+        if projected is None:
+            with self._lock:
+                projected = self._projections.get(key)
+                if projected is None:
+                    tree = _field_tree(fields)
+                    self._check_fields(typeid, tree, '')
+                    projected = self._project(typeid, tree)
+                    self._projections[key] = projected
+        return projected
+
+    def _check_fields(self, typeid, tree, prefix):
+        names = self._field_types(typeid, ())
+        for name, subtree in tree.iteritems():
+            if name not in names:
+                raise ValueError('field(%r)' % (prefix + name,))
+            if subtree is not None:
+                self._check_fields(names[name], subtree, prefix + name + '.')
+
+    def _field_types(self, typeid, seen):
+        # Returns the typeid of each field name that paths can select in
+        # typeid: struct fields, with those of a __parent merged in, and
+        # choice variants, also through arrays and optionals.
+        if typeid >= len(self._typeinfos) or typeid in seen:
+            return {}
+        seen += (typeid,)
+        kind, args = self._typeinfos[typeid]
+        names = {}
+        if kind == '_struct':
+            for f in args[0]:
+                if f[0] == '__parent':
+                    names.update(self._field_types(f[1], seen))
+                else:
+                    names[f[0]] = f[1]
+        elif kind == '_choice':
+            for f in args[1].itervalues():
+                names[f[0]] = f[1]
+        elif kind == '_array':
+            names = self._field_types(args[1], seen)
+        elif kind == '_optional':
+            names = self._field_types(args[0], seen)
+        return names
+
+    def _lookup(self, table, prefix, typeid):
+        if typeid >= len(self._typeinfos):
+            def _corrupted(buffer):
+                raise CorruptedError(buffer)
+            return _corrupted
+        compiled = table[typeid]
+        if compiled is None:
+            with self._lock:
+                compiled = table[typeid]
+                if compiled is None:
+                    compiled = self._compile(table, prefix, typeid)
+        return compiled
+
+    def _compile(self, table, prefix, typeid):
+        # Recursive types get a stand-in while their own decoder is being
+        # compiled. It stays out of the table, where other threads would
+        # find it unfinished, and looks the decoder up when first called.
+        key = (prefix, typeid)
+        compiled = self._pending.get(key)
+        if compiled is not None:
+            return compiled
+        self._pending[key] = lambda buffer: self._lookup(table, prefix, typeid)(buffer)
+        try:
+            typeinfo = self._typeinfos[typeid]
+            compiled = getattr(self, prefix + typeinfo[0])(*typeinfo[1])
+        finally:
+            del self._pending[key]
+        table[typeid] = compiled
+        return compiled
+
+    def _project(self, typeid, tree):
+        if tree is None or typeid >= len(self._typeinfos):
+            return self.instance(typeid)
+        typeinfo = self._typeinfos[typeid]
+        project = getattr(self, '_project' + typeinfo[0], None)
+        if project is None:
+            return self.instance(typeid)
+        return project(tree, *typeinfo[1])
+
+    def parent_is_dict(self, typeid, seen=()):
+        # Whether a __parent field of this type always decodes to a dict, so
+        # structs can merge it without checking the decoded value.
+        if typeid >= len(self._typeinfos) or typeid in seen:
+            return False
+        typeinfo = self._typeinfos[typeid]
+        if typeinfo[0] == '_choice':
+            return True
+        if typeinfo[0] != '_struct':
+            return False
+        fields = typeinfo[1][0]
+        if len(fields) == 1 and fields[0][0] == '__parent':
+            return self.parent_is_dict(fields[0][1], seen + (typeid,))
+        return True
+
     def _array(self, bounds, typeid):
+        if typeid < len(self._typeinfos) and self._typeinfos[typeid][0] == '_int':
+            element_bounds = self._typeinfos[typeid][1][0]
+            return self._build_int_array(bounds, element_bounds,
+                                         _int_array_type(self._int_arrays, element_bounds))
+        return self._build_array(bounds, self.instance(typeid))
+
+    def _project_array(self, tree, bounds, typeid):
+        if typeid < len(self._typeinfos) and self._typeinfos[typeid][0] == '_int':
+            return self._array(bounds, typeid)
+        return self._build_array(bounds, self._project(typeid, tree))
+
+    def _null(self):
+        return lambda buffer: None
+
+    def _optional(self, typeid):
+        return self._build_optional(self.instance(typeid))
+
+    def _project_optional(self, tree, typeid):
+        return self._build_optional(self._project(typeid, tree))
+
+
+def _int_array_type(int_arrays, bounds):
+    # Returns the constructor for int arrays with these element bounds, or
+    # None to keep the decoded list. Arrays use 32 bit items when the bounds
+    # allow it; values outside the bounds keep the list.
+    if int_arrays is None:
+        return None
+    small = bounds[0] >= -0x80000000 and bounds[0] + (1 << bounds[1]) <= 0x80000000
+    if int_arrays == 'array':
+        typecode = 'i' if small else 'l'
+        def _int_array(values):
+            try:
+                return array.array(typecode, values)
+            except OverflowError:
+                return values
+        return _int_array
+    if int_arrays == 'numpy':
+        import numpy
+        dtype = numpy.int32 if small else numpy.int64
+        def _int_array(values):
+            try:
+                return numpy.array(values, dtype=dtype)
+            except OverflowError:
+                return values
+        return _int_array
+    raise ValueError('int_arrays(%r)' % (int_arrays,))
+
+
+def _field_tree(paths):
+    # Nests dotted field paths, {'m_abil': {'m_abilLink': None}}, where None
+    # selects the whole value.
+    tree = {}
+    for path in paths:
+        node = tree
+        names = path.split('.')
+        for name in names[:-1]:
+            node = node.setdefault(name, {})
+            if node is None:
+                break
+        else:
+            node[names[-1]] = None
+    return tree
+
+
+class BitPackedCompiler(_TypeinfoCompiler):
+    def __init__(self, typeinfos, int_arrays=None):
+        _TypeinfoCompiler.__init__(self, typeinfos, int_arrays)
+        self._fixed_bits = {}
+
+    def fixed_bits(self, typeid):
+        # Returns the constant encoded width of typeid in bits, or None when
+        # it depends on the value: variable lengths, optionals, choices of
+        # differing widths and anything aligned like blobs. Held under the
+        # lock, as types being sized are marked None in the shared cache.
+        with self._lock:
+            if typeid >= len(self._typeinfos):
+                return None
+            if typeid in self._fixed_bits:
+                return self._fixed_bits[typeid]
+            self._fixed_bits[typeid] = None  # recursive types are not fixed
+            kind, args = self._typeinfos[typeid]
+            bits = None
+            if kind == '_int':
+                bits = args[0][1]
+            elif kind == '_bool':
+                bits = 1
+            elif kind in ('_fourcc', '_real32'):
+                bits = 32
+            elif kind == '_real64':
+                bits = 64
+            elif kind == '_null':
+                bits = 0
+            elif kind == '_bitarray':
+                if args[0][1] == 0:
+                    bits = args[0][0]
+            elif kind == '_array':
+                element = self.fixed_bits(args[1])
+                if args[0][1] == 0 and element is not None:
+                    bits = args[0][0] * element
+            elif kind == '_choice':
+                widths = set(self.fixed_bits(f[1]) for f in args[1].itervalues())
+                if len(widths) == 1 and None not in widths:
+                    bits = args[0][1] + widths.pop()
+            elif kind == '_struct':
+                widths = [self.fixed_bits(f[1]) for f in args[0]]
+                if None not in widths:
+                    bits = sum(widths)
+            self._fixed_bits[typeid] = bits
+            return bits
+
+    def skip(self, typeid):
+        # constant width values are skipped with a single position bump
+        if typeid < len(self._typeinfos) and self._skips[typeid] is None:
+            bits = self.fixed_bits(typeid)
+            if bits is not None:
+                self._skips[typeid] = self._skip_bits(bits)
+        return _TypeinfoCompiler.skip(self, typeid)
+
+    def _build_array(self, bounds, element):
         length = self._int(bounds)
-        return [self.instance(typeid) for i in xrange(length)]
+        def _array(buffer):
+            return [element(buffer) for i in xrange(length(buffer))]
+        return _array
+
+    def _build_int_array(self, bounds, element_bounds, array_type):
+        length = self._int(bounds)
+        offset, bits = element_bounds
+        def _int_array(buffer):
+            if bits == 0:
+                values = [offset] * length(buffer)
+            else:
+                values = buffer.read_bits_array(bits, length(buffer))
+                if offset:
+                    values = [offset + value for value in values]
+            return values if array_type is None else array_type(values)
+        return _int_array
 
     def _bitarray(self, bounds):
         length = self._int(bounds)
-        return (length, self._buffer.read_bits(length))
+        def _bitarray(buffer):
+            bits = length(buffer)
+            return (bits, buffer.read_bits(bits))
+        return _bitarray
 
     def _blob(self, bounds):
         length = self._int(bounds)
-        result = self._buffer.read_aligned_bytes(length)
-        return result
+        def _blob(buffer):
+            return buffer.read_blob(length(buffer))
+        return _blob
 
     def _bool(self):
-        return self._int((0, 1)) != 0
+        def _bool(buffer):
+            return buffer.read_bits(1) != 0
+        return _bool
 
     def _choice(self, bounds, fields):
+        return self._build_choice(bounds, dict(
+            (tag, (f[0], self.instance(f[1]))) for tag, f in fields.iteritems()))
+
+    def _project_choice(self, tree, bounds, fields):
+        return self._build_choice(bounds, dict(
+            (tag, (f[0], self._project(f[1], tree[f[0]])) if f[0] in tree else (None, self.skip(f[1])))
+            for tag, f in fields.iteritems()))
+
+    def _build_choice(self, bounds, choices):
         tag = self._int(bounds)
-        if tag not in fields:
-            raise CorruptedError(self)
-        field = fields[tag]
-        return {field[0]: self.instance(field[1])}
+        def _choice(buffer):
+            field = choices.get(tag(buffer))
+            if field is None:
+                raise CorruptedError(buffer)
+            if field[0] is None:
+                field[1](buffer)
+                return {}
+            return {field[0]: field[1](buffer)}
+        return _choice
 
     def _fourcc(self):
-        return self._buffer.read_unaligned_bytes(4)
+        def _fourcc(buffer):
+            return buffer.read_unaligned_bytes(4)
+        return _fourcc
 
-    def _int(self, bounds):
-        return bounds[0] + self._buffer.read_bits(bounds[1])
+    def _int_choice(self, bounds, choices):
+        tag = self._int(bounds)
+        def _int_choice(buffer):
+            value = choices.get(tag(buffer))
+            if value is None:
+                raise CorruptedError(buffer)
+            return value(buffer)
+        return _int_choice
 
-    def _null(self):
-        return None
+    def _int_struct(self, tag, value):
+        return value
 
-    def _optional(self, typeid):
-        exists = self._bool()
-        return self.instance(typeid) if exists else None
+    def _int(self, bounds):
+        offset, bits = bounds
+        if bits == 0:
+            return lambda buffer: offset
+        def _int(buffer):
+            return offset + buffer.read_bits(bits)
+        return _int
+
+    def _build_optional(self, value):
+        def _optional(buffer):
+            return value(buffer) if buffer.read_bits(1) != 0 else None
+        return _optional
 
     def _real32(self):
-        return struct.unpack('>f', self._buffer.read_unaligned_bytes(4))
+        def _real32(buffer):
+            return struct.unpack('>f', buffer.read_unaligned_bytes(4))
+        return _real32
 
     def _real64(self):
-        return struct.unpack('>d', self._buffer.read_unaligned_bytes(8))
+        def _real64(buffer):
+            return struct.unpack('>d', buffer.read_unaligned_bytes(8))
+        return _real64
 
     def _struct(self, fields):
-        result = {}
-        for field in fields:
-            if field[0] == '__parent':
-                parent = self.instance(field[1])
-                if isinstance(parent, dict):
-                    result.update(parent)
-                elif len(fields) == 1:
-                    result = parent
-                else:
-                    result[field[0]] = parent
+        return self._build_struct(fields, [(f[0], self.instance(f[1])) for f in fields])
+
+    def _project_struct(self, tree, fields):
+        compiled = []
+        for f in fields:
+            if f[0] in tree:
+                compiled.append((f[0], self._project(f[1], tree[f[0]])))
+            elif f[0] == '__parent':
+                compiled.append((f[0], self._project(f[1], tree)))
             else:
-                result[field[0]] = self.instance(field[1])
-        return result
+                compiled.append((None, self.skip(f[1])))
+        return self._build_struct(fields, compiled)
 
+    def _build_struct(self, fields, compiled):
+        # compiled holds (name, decoder) per field; a None name skips it
+        parent = next((f for f in fields if f[0] == '__parent'), None)
+        if parent is None and all(name is not None for name, value in compiled):
+            def _struct(buffer):
+                result = {}
+                for name, value in compiled:
+                    result[name] = value(buffer)
+                return result
+            return _struct
+        merge = parent is not None and self.parent_is_dict(parent[1])
+        single = len(fields) == 1
+        def _struct(buffer):
+            result = {}
+            for name, value in compiled:
+                if name is None:
+                    value(buffer)
+                elif name == '__parent':
+                    parent = value(buffer)
+                    if merge or isinstance(parent, dict):
+                        result.update(parent)
+                    elif single:
+                        result = parent
+                    else:
+                        result[name] = parent
+                else:
+                    result[name] = value(buffer)
+            return result
+        return _struct
 
-class VersionedDecoder:
-    def __init__(self, contents, typeinfos):
-        self._buffer = BitPackedBuffer(contents)
-        self._typeinfos = typeinfos
+    def _skip_array(self, bounds, typeid):
+        length = self._int(bounds)
+        element = self.skip(typeid)
+        def _skip_array(buffer):
+            for i in xrange(length(buffer)):
+                element(buffer)
+        return _skip_array
 
-    def __str__(self):
-        return self._buffer.__str__()
+    def _skip_bitarray(self, bounds):
+        length = self._int(bounds)
+        def _skip_bitarray(buffer):
+            buffer.skip_bits(length(buffer))
+        return _skip_bitarray
 
-    def instance(self, typeid):
-        if typeid >= len(self._typeinfos):
-            raise CorruptedError(self)
-        typeinfo = self._typeinfos[typeid]
-        return getattr(self, typeinfo[0])(*typeinfo[1])
+    def _skip_blob(self, bounds):
+        length = self._int(bounds)
+        def _skip_blob(buffer):
+            bytes = length(buffer)
+            buffer.byte_align()
+            buffer.skip_bits(bytes * 8)
+        return _skip_blob
 
-    def byte_align(self):
-        self._buffer.byte_align()
+    def _skip_bool(self):
+        return self._bool()
 
-    def done(self):
-        return self._buffer.done()
+    def _skip_choice(self, bounds, fields):
+        tag = self._int(bounds)
+        choices = dict((t, self.skip(f[1])) for t, f in fields.iteritems())
+        def _skip_choice(buffer):
+            skip = choices.get(tag(buffer))
+            if skip is None:
+                raise CorruptedError(buffer)
+            skip(buffer)
+        return _skip_choice
 
-    def used_bits(self):
-        return self._buffer.used_bits()
+    def _skip_fourcc(self):
+        return self._skip_bits(32)
 
-    def _expect_skip(self, expected):
-        if self._buffer.read_bits(8) != expected:
-            raise CorruptedError(self)
+    def _skip_int(self, bounds):
+        return self._skip_bits(bounds[1])
 
-    def _vint(self):
-        b = self._buffer.read_bits(8)
-        negative = b & 1
-        result = (b >> 1) & 0x3f
-        bits = 6
-        while (b & 0x80) != 0:
-            b = self._buffer.read_bits(8)
-            result |= (b & 0x7f) << bits
-            bits += 7
-        return -result if negative else result
+    def _skip_null(self):
+        return self._null()
 
-    def _array(self, bounds, typeid):
-        self._expect_skip(0)
-        length = self._vint()
-        return [self.instance(typeid) for i in xrange(length)]
+    def _skip_optional(self, typeid):
+        value = self.skip(typeid)
+        def _skip_optional(buffer):
+            if buffer.read_bits(1) != 0:
+                value(buffer)
+        return _skip_optional
+
+    def _skip_real32(self):
+        return self._skip_bits(32)
+
+    def _skip_real64(self):
+        return self._skip_bits(64)
+
+    def _skip_struct(self, fields):
+        skips = [self.skip(f[1]) for f in fields]
+        def _skip_struct(buffer):
+            for skip in skips:
+                skip(buffer)
+        return _skip_struct
+
+    def _skip_bits(self, bits):
+        if bits == 0:
+            return self._null()
+        def _skip_bits(buffer):
+            buffer.skip_bits(bits)
+        return _skip_bits
+
+
+class VersionedCompiler(_TypeinfoCompiler):
+    def __init__(self, typeinfos, int_arrays=None, inline=()):
+        _TypeinfoCompiler.__init__(self, typeinfos, int_arrays)
+        self._with_null = None
+        # structs are recognized by their fields list, which projections of
+        # the struct share
+        self._inline = set(id(typeinfos[typeid][1][0]) for typeid in self.reachable(inline)
+                           if typeinfos[typeid][0] == '_struct')
+
+    def skip(self, typeid):
+        # values that cannot hold a null are fully tagged, so the buffer's
+        # skip_instance steps over them without a typed walk
+        if typeid < len(self._typeinfos) and self._skips[typeid] is None:
+            if typeid not in self.with_null():
+                self._skips[typeid] = _skip_versioned
+        return _TypeinfoCompiler.skip(self, typeid)
+
+    def reachable(self, typeids):
+        # Returns typeids and the typeids of all values within them.
+        reachable = set()
+        pending = [typeid for typeid in typeids if typeid < len(self._typeinfos)]
+        while pending:
+            typeid = pending.pop()
+            if typeid not in reachable:
+                reachable.add(typeid)
+                pending.extend(i for i in self._children(typeid) if i < len(self._typeinfos))
+        return reachable
+
+    def _children(self, typeid):
+        kind, args = self._typeinfos[typeid]
+        if kind == '_array':
+            return [args[1]]
+        if kind == '_optional':
+            return [args[0]]
+        if kind == '_struct':
+            return [f[1] for f in args[0]]
+        if kind == '_choice':
+            return [f[1] for f in args[1].itervalues()]
+        return []
+
+    def with_null(self):
+        # Returns the typeids whose values may contain a null somewhere.
+        if self._with_null is None:
+            children = [self._children(typeid) for typeid in xrange(len(self._typeinfos))]
+            with_null = set(typeid for typeid, typeinfo in enumerate(self._typeinfos) if typeinfo[0] == '_null')
+            grown = True
+            while grown:
+                grown = False
+                for typeid, ids in enumerate(children):
+                    if typeid not in with_null and any(i in with_null for i in ids):
+                        with_null.add(typeid)
+                        grown = True
+            self._with_null = with_null
+        return self._with_null
+
+    def _build_array(self, bounds, element):
+        def _array(buffer):
+            buffer.expect_skip(0)
+            return [element(buffer) for i in xrange(buffer.read_vint())]
+        return _array
+
+    def _build_int_array(self, bounds, element_bounds, array_type):
+        def _int_array(buffer):
+            buffer.expect_skip(0)
+            values = buffer.read_vint_array(buffer.read_vint())
+            return values if array_type is None else array_type(values)
+        return _int_array
 
     def _bitarray(self, bounds):
-        self._expect_skip(1)
-        length = self._vint()
-        return (length, self._buffer.read_aligned_bytes((length + 7) / 8))
+        def _bitarray(buffer):
+            buffer.expect_skip(1)
+            length = buffer.read_vint()
+            return (length, buffer.read_aligned_bytes((length + 7) / 8))
+        return _bitarray
 
     def _blob(self, bounds):
-        self._expect_skip(2)
-        length = self._vint()
-        return self._buffer.read_aligned_bytes(length)
+        def _blob(buffer):
+            buffer.expect_skip(2)
+            return buffer.read_blob(buffer.read_vint())
+        return _blob
 
     def _bool(self):
-        self._expect_skip(6)
-        return self._buffer.read_bits(8) != 0
+        def _bool(buffer):
+            buffer.expect_skip(6)
+            return buffer.read_u8() != 0
+        return _bool
 
     def _choice(self, bounds, fields):
-        self._expect_skip(3)
-        tag = self._vint()
-        if tag not in fields:
-            self._skip_instance()
-            return {}
-        field = fields[tag]
-        return {field[0]: self.instance(field[1])}
+        return self._build_choice(dict(
+            (tag, (f[0], self.instance(f[1]))) for tag, f in fields.iteritems()))
+
+    def _project_choice(self, tree, bounds, fields):
+        return self._build_choice(dict(
+            (tag, (f[0], self._project(f[1], tree[f[0]])) if f[0] in tree else (None, self.skip(f[1])))
+            for tag, f in fields.iteritems()))
+
+    def _build_choice(self, choices):
+        def _choice(buffer):
+            buffer.expect_skip(3)
+            field = choices.get(buffer.read_vint())
+            if field is None:
+                buffer.skip_instance()
+                return {}
+            if field[0] is None:
+                field[1](buffer)
+                return {}
+            return {field[0]: field[1](buffer)}
+        return _choice
 
     def _fourcc(self):
-        self._expect_skip(7)
-        return self._buffer.read_aligned_bytes(4)
+        def _fourcc(buffer):
+            buffer.expect_skip(7)
+            return buffer.read_aligned_bytes(4)
+        return _fourcc
 
-    def _int(self, bounds):
-        self._expect_skip(9)
-        return self._vint()
+    def _int_choice(self, bounds, choices):
+        def _int_choice(buffer):
+            buffer.expect_skip(3)
+            value = choices.get(buffer.read_vint())
+            if value is None:
+                buffer.skip_instance()
+                return 0
+            return value(buffer)
+        return _int_choice
 
-    def _null(self):
-        return None
+    def _int_struct(self, tag, value):
+        def _int_struct(buffer):
+            buffer.expect_skip(5)
+            result = 0
+            for i in xrange(buffer.read_vint()):
+                if buffer.read_vint() == tag:
+                    result = value(buffer)
+                else:
+                    buffer.skip_instance()
+            return result
+        return _int_struct
 
-    def _optional(self, typeid):
-        self._expect_skip(4)
-        exists = self._buffer.read_bits(8) != 0
-        return self.instance(typeid) if exists else None
+    def _int(self, bounds):
+        def _int(buffer):
+            buffer.expect_skip(9)
+            return buffer.read_vint()
+        return _int
+
+    def _build_optional(self, value):
+        def _optional(buffer):
+            buffer.expect_skip(4)
+            return value(buffer) if buffer.read_u8() != 0 else None
+        return _optional
 
     def _real32(self):
-        self._expect_skip(7)
-        return struct.unpack('>f', self._buffer.read_aligned_bytes(4))
+        def _real32(buffer):
+            buffer.expect_skip(7)
+            return struct.unpack('>f', buffer.read_aligned_bytes(4))
+        return _real32
 
     def _real64(self):
-        self._expect_skip(8)
-        return struct.unpack('>d', self._buffer.read_aligned_bytes(8))
+        def _real64(buffer):
+            buffer.expect_skip(8)
+            return struct.unpack('>d', buffer.read_aligned_bytes(8))
+        return _real64
 
     def _struct(self, fields):
-        self._expect_skip(5)
-        result = {}
-        length = self._vint()
-        for i in xrange(length):
-            tag = self._vint()
-            field = next((f for f in fields if f[2] == tag), None)
-            if field:
-                if field[0] == '__parent':
-                    parent = self.instance(field[1])
-                    if isinstance(parent, dict):
+        return self._build_struct(fields, [(f[0], self.instance(f[1])) for f in fields])
+
+    def _project_struct(self, tree, fields):
+        compiled = []
+        for f in fields:
+            if f[0] in tree:
+                compiled.append((f[0], self._project(f[1], tree[f[0]])))
+            elif f[0] == '__parent':
+                compiled.append((f[0], self._project(f[1], tree)))
+            else:
+                compiled.append((None, self.skip(f[1])))
+        return self._build_struct(fields, compiled)
+
+    def _build_struct(self, fields, compiled):
+        # compiled holds (name, decoder) per field; a None name skips it.
+        # Fields are looked up by tag and the first wins on a repeated tag.
+        tags = {}
+        for f, field in reversed(zip(fields, compiled)):
+            tags[f[2]] = field
+        parent = next((f for f in fields if f[0] == '__parent'), None)
+        if parent is None and all(name is not None for name, value in compiled):
+            def _struct(buffer):
+                buffer.expect_skip(5)
+                result = {}
+                for i in xrange(buffer.read_vint()):
+                    field = tags.get(buffer.read_vint())
+                    if field is None:
+                        buffer.skip_instance()
+                    else:
+                        result[field[0]] = field[1](buffer)
+                return result
+            if id(fields) in self._inline:
+                return self._build_inline_struct(fields, compiled, _struct) or _struct
+            return _struct
+        merge = parent is not None and self.parent_is_dict(parent[1])
+        single = len(fields) == 1
+        def _struct(buffer):
+            buffer.expect_skip(5)
+            result = {}
+            for i in xrange(buffer.read_vint()):
+                field = tags.get(buffer.read_vint())
+                if field is None:
+                    buffer.skip_instance()
+                elif field[0] is None:
+                    field[1](buffer)
+                elif field[0] == '__parent':
+                    parent = field[1](buffer)
+                    if merge or isinstance(parent, dict):
                         result.update(parent)
-                    elif len(fields) == 1:
+                    elif single:
                         result = parent
                     else:
                         result[field[0]] = parent
                 else:
-                    result[field[0]] = self.instance(field[1])
+                    result[field[0]] = field[1](buffer)
+            return result
+        if id(fields) in self._inline and (parent is None or merge):
+            return self._build_inline_struct(fields, compiled, _struct) or _struct
+        return _struct
+
+    def _build_inline_struct(self, fields, compiled, generic):
+        # Generates straight-line code for structs written the way the game
+        # writes them: every field once and in order, with the field count
+        # and tags below 64 so that each is a single byte. Ints and optional
+        # ints are read inline and other fields by their decoders, with a
+        # __parent merged in where the generic struct would. On
+        # anything else, such as an unknown tag, another field order or the
+        # end of the data, it rewinds and decodes with the generic struct,
+        # which also raises the same errors. Returns None for structs that
+        # do not qualify.
+        tags = [f[2] for f in fields]
+        if not fields or len(fields) >= 64 or len(set(tags)) != len(tags) or not all(0 <= tag < 64 for tag in tags):
+            return None
+        namespace = {'generic': generic, 'TruncatedError': TruncatedError, 'CorruptedError': CorruptedError}
+        body = []
+        def expect(indent, checks):
+            # falls back unless data[used + offset] == byte for each check
+            body.append(indent + 'if %s:' % ' or '.join('data[used + %d] != %r' % check for check in checks))
+            body.append(indent + '    buffer._used = start')
+            body.append(indent + '    return generic(buffer)')
+        def vint(indent, offset, target):
+            # reads the vint at used + offset into target, moving used past it
+            body.extend(indent + line for line in [
+                'b = ord(data[used + %d])' % offset,
+                'used += %d' % (offset + 1),
+                'value = b >> 1 & 0x3f',
+                'negative = b & 1',
+                'bits = 6',
+                'while b & 0x80:',
+                '    b = ord(data[used])',
+                '    used += 1',
+                '    value |= (b & 0x7f) << bits',
+                '    bits += 7',
+                '%s = -value if negative else value' % target])
+        expect('        ', [(0, '\x05'), (1, chr(2 * len(fields)))])
+        body.append('        used += 2')
+        for i, (f, (name, value)) in enumerate(zip(fields, compiled)):
+            kind, args = self._typeinfos[f[1]]
+            tag = chr(2 * f[2])
+            if kind == '_int':
+                expect('        ', [(0, tag), (1, '\x09')])
+                vint('        ', 2, 'v%d' % i)
+            elif kind == '_optional' and self._typeinfos[args[0]][0] == '_int':
+                expect('        ', [(0, tag), (1, '\x04')])
+                body += ['        if data[used + 2] == %r:' % '\x00',
+                         '            v%d = None' % i,
+                         '            used += 3',
+                         '        else:']
+                expect('            ', [(3, '\x09')])
+                vint('            ', 4, 'v%d' % i)
             else:
-                self._skip_instance()
-        return result
+                namespace['d%d' % i] = value
+                expect('        ', [(0, tag)])
+                body += ['        buffer._used = used + 1',
+                         '        v%d = d%d(buffer)' % (i, i),
+                         '        used = buffer._used']
+        if any(name is None or name == '__parent' for name, value in compiled):
+            result = ['    result = {}']
+            for i, (name, value) in enumerate(compiled):
+                if name == '__parent':
+                    result.append('    result.update(v%d)' % i)
+                elif name is not None:
+                    result.append('    result[%r] = v%d' % (name, i))
+            result.append('    return result')
+        else:
+            result = ['    return {%s}' % ', '.join('%r: v%d' % (name, i) for i, (name, value) in enumerate(compiled))]
+        source = '\n'.join([
+            'def _struct(buffer):',
+            '    data = buffer._data',
+            '    start = used = buffer._used',
+            '    try:'] + body + [
+            '    except (IndexError, TruncatedError, CorruptedError):',
+            '        buffer._used = start',
+            '        return generic(buffer)',
+            '    buffer._used = used'] + result)
+        exec source in namespace
+        return namespace['_struct']
+
+    # Values are tagged, so skip_instance can step over any of them. Only
+    # containers need typed skips, because null values have no tag at all.
+    def _skip_array(self, bounds, typeid):
+        element = self.skip(typeid)
+        def _skip_array(buffer):
+            buffer.expect_skip(0)
+            for i in xrange(buffer.read_vint()):
+                element(buffer)
+        return _skip_array
+
+    def _skip_bitarray(self, bounds):
+        return _skip_versioned
+
+    def _skip_blob(self, bounds):
+        return _skip_versioned
+
+    def _skip_bool(self):
+        return _skip_versioned
+
+    def _skip_choice(self, bounds, fields):
+        choices = dict((tag, self.skip(f[1])) for tag, f in fields.iteritems())
+        def _skip_choice(buffer):
+            buffer.expect_skip(3)
+            skip = choices.get(buffer.read_vint(), _skip_versioned)
+            skip(buffer)
+        return _skip_choice
+
+    def _skip_fourcc(self):
+        return _skip_versioned
+
+    def _skip_int(self, bounds):
+        return _skip_versioned
+
+    def _skip_null(self):
+        return self._null()
+
+    def _skip_optional(self, typeid):
+        value = self.skip(typeid)
+        def _skip_optional(buffer):
+            buffer.expect_skip(4)
+            if buffer.read_u8() != 0:
+                value(buffer)
+        return _skip_optional
+
+    def _skip_real32(self):
+        return _skip_versioned
+
+    def _skip_real64(self):
+        return _skip_versioned
+
+    def _skip_struct(self, fields):
+        tags = {}
+        for f in reversed(fields):
+            tags[f[2]] = self.skip(f[1])
+        def _skip_struct(buffer):
+            buffer.expect_skip(5)
+            for i in xrange(buffer.read_vint()):
+                skip = tags.get(buffer.read_vint(), _skip_versioned)
+                skip(buffer)
+        return _skip_struct
+
+
+def _skip_versioned(buffer):
+    buffer.skip_instance()
+
+
+class Record(object):
+    # Base of the __slots__ classes that structs decode to in records mode.
+    # Records support the mapping operations used on the decoded dicts, so
+    # they can stand in for them; a slot that was never set is a missing key.
+    __slots__ = ()
+    _keys = frozenset()
+
+    def __getitem__(self, key):
+        if key in self._keys:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                pass
+        raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        if key not in self._keys:
+            raise KeyError(key)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        delattr(self, key)
+
+    def __contains__(self, key):
+        return key in self._keys and hasattr(self, key)
+
+    def __iter__(self):
+        return (key for key in self.__slots__ if hasattr(self, key))
+
+    def __len__(self):
+        return sum(1 for key in self)
+
+    def __eq__(self, other):
+        if isinstance(other, (dict, Record)):
+            return dict(self.iteritems()) == dict(other.iteritems())
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(dict(self.iteritems()))
+
+    def get(self, key, default=None):
+        return getattr(self, key, default) if key in self._keys else default
+
+    def keys(self):
+        return list(self)
+
+    def values(self):
+        return [getattr(self, key) for key in self]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self]
+
+    def iterkeys(self):
+        return iter(self)
+
+    def itervalues(self):
+        return (getattr(self, key) for key in self)
+
+    def iteritems(self):
+        return ((key, getattr(self, key)) for key in self)
+
+    def update(self, other):
+        for key, value in other.iteritems():
+            self[key] = value
+
+
+# Keys the event stream decoders add to every event.
+event_keys = ('_event', '_eventid', '_gameloop', '_userid', '_bits')
+
+
+def _ignore(record, value):
+    pass
+
+
+class _RecordCompilerMixin:
+    # Compiles structs to generated Record classes instead of dicts. Fields
+    # merged in from a __parent become slots of the child's class. Structs
+    # whose parent may not decode to a mapping stay dicts.
+    def record_class(self, fields):
+        key = id(fields)
+        if key not in self._records:
+            names = self._record_keys(fields)
+            if names is None:
+                self._records[key] = None
+            else:
+                slots = tuple(sorted(set(names))) + event_keys
+                self._records[key] = type('Struct', (Record,), {
+                    '__slots__': slots,
+                    '_keys': frozenset(slots),
+                })
+        return self._records[key]
+
+    def _record_keys(self, fields):
+        names = []
+        for f in fields:
+            if f[0] != '__parent':
+                names.append(f[0])
+                continue
+            kind, args = self._typeinfos[f[1]]
+            if kind == '_choice':
+                names.extend(choice[0] for choice in args[1].itervalues())
+            elif kind == '_struct' and self.parent_is_dict(f[1]):
+                parent = self._record_keys(args[0])
+                if parent is None:
+                    return None
+                names.extend(parent)
+            else:
+                return None
+        return names
+
+    def _record_setters(self, cls, compiled):
+        # how each compiled (name, decoder) field is stored on a record
+        setters = []
+        for name, value in compiled:
+            if name is None:
+                setters.append((_ignore, value))
+            elif name == '__parent':
+                setters.append((Record.update, value))
+            else:
+                setters.append((cls.__dict__[name].__set__, value))
+        return setters
+
+
+class BitPackedRecordCompiler(_RecordCompilerMixin, BitPackedCompiler):
+    def __init__(self, typeinfos, int_arrays=None):
+        BitPackedCompiler.__init__(self, typeinfos, int_arrays)
+        self._records = {}
+
+    def _build_struct(self, fields, compiled):
+        cls = self.record_class(fields)
+        if cls is None:
+            return BitPackedCompiler._build_struct(self, fields, compiled)
+        setters = self._record_setters(cls, compiled)
+        def _struct(buffer):
+            result = cls()
+            for setter, value in setters:
+                setter(result, value(buffer))
+            return result
+        return _struct
+
+
+class VersionedRecordCompiler(_RecordCompilerMixin, VersionedCompiler):
+    def __init__(self, typeinfos, int_arrays=None):
+        VersionedCompiler.__init__(self, typeinfos, int_arrays)
+        self._records = {}
+
+    def _build_struct(self, fields, compiled):
+        cls = self.record_class(fields)
+        if cls is None:
+            return VersionedCompiler._build_struct(self, fields, compiled)
+        tags = {}
+        for f, field in reversed(zip(fields, self._record_setters(cls, compiled))):
+            tags[f[2]] = field
+        def _struct(buffer):
+            buffer.expect_skip(5)
+            result = cls()
+            for i in xrange(buffer.read_vint()):
+                field = tags.get(buffer.read_vint())
+                if field is None:
+                    buffer.skip_instance()
+                else:
+                    field[0](result, field[1](buffer))
+            return result
+        return _struct
+
+
+def fixed_bit_sizes(typeinfos):
+    # Constant bit-packed width of every typeid, None where it varies.
+    compiler = get_compiler(BitPackedCompiler, typeinfos)
+    return [compiler.fixed_bits(typeid) for typeid in xrange(len(typeinfos))]
+
+
+_compilers = {}
+
+
+def get_compiler(compiler, typeinfos, **options):
+    # Compilers are cached per protocol build and options, keyed on the
+    # typeinfos list object which is kept alive alongside its compiler.
+    key = (compiler, id(typeinfos), tuple(sorted(options.items())))
+    entry = _compilers.get(key)
+    if entry is None:
+        entry = (typeinfos, compiler(typeinfos, **options))
+        entry[1].compile()
+        _compilers[key] = entry
+    return entry[1]
+
+
+# Event streams
+#
+# The game, message and tracker events are streams of events, each framed
+# by its gameloop delta from the previous event (a SVarUint32 choice), for
+# game and message events its userid and then its eventid, which selects
+# the typeid of the event from the protocol's event_types. The protocol
+# modules decode their streams with these functions, passing their own
+# decoder class and typeids; userid_typeid is None for streams without
+# userids.
+#
+# decode_event_stream, and so the protocol's decode_replay_*_events, takes
+# these options:
+#
+#   fields maps event names to lists of the dotted field paths to decode
+#   for those events, e.g. ['m_abil.m_abilLink']; other fields are skipped.
+#   Unknown event names and paths that name no field raise ValueError.
+#
+#   event_filter restricts decoding to a set of eventids and/or event names;
+#   other events are skipped without being built. Ids and names of no event
+#   raise ValueError.
+#
+#   zero_copy returns blobs as views into contents instead of copies;
+#   contents may then be a str, bytearray, memoryview or mmap.
+#
+#   records decodes structs to compact __slots__ Record objects that support
+#   the same mapping access as the default dicts.
+#
+#   int_arrays returns arrays of ints as 'array' array.array or 'numpy'
+#   arrays instead of lists.
+#
+#   buffer_class selects the bit reader of the game and message streams,
+#   BitPackedBuffer by default or WordBitPackedBuffer; the tracker stream
+#   is not bit-packed and raises ValueError for it.
+#
+#   start_gameloop and end_gameloop limit decoding to the events with
+#   gameloops in that inclusive window; earlier events are skipped and
+#   decoding stops after the window. index, the checkpoints returned by the
+#   protocol's index_replay_*_events for the same contents, lets decoding
+#   start at the checkpoint nearest start_gameloop.
+#
+#   workers decodes the stream in segments between the checkpoints of index
+#   on that many processes, or on a given multiprocessing pool; see
+#   decode_parallel. It needs an index, because building one walks the
+#   whole stream serially, which would cap the speedup; keep the index of
+#   a replay that is decoded more than once.
+#
+# contents may also be an iterator of byte string chunks, such as an
+# MPQArchive.open_file file or read_file_sectors, which is only advanced as
+# far as decoding gets. Such contents cannot be used with an index or
+# workers.
+
+def decode_event_stream(decode, contents, decoder_class, typeinfos, eventid_typeid, event_types,
+                        svaruint32_typeid, userid_typeid=None, fields=None, event_filter=None,
+                        zero_copy=False, records=False, int_arrays=None, buffer_class=None,
+                        start_gameloop=None, end_gameloop=None, index=None, workers=None):
+    # Decodes and yields the events of contents. decode is the protocol
+    # function calling this, which workers call on their segments.
+    if buffer_class is not None and decoder_class is not BitPackedDecoder:
+        raise ValueError('buffer_class(%r) for a stream that is not bit-packed' % (buffer_class,))
+    if event_filter is not None:
+        event_filter = _event_filter_ids(event_types, event_filter)
+    if fields:
+        names = set(typename for typeid, typename in event_types.itervalues())
+        for typename in fields:
+            if typename not in names:
+                raise ValueError('fields(%r)' % (typename,))
+
+    if workers is not None:
+        if index is None:
+            raise ValueError('workers need an index of the contents')
+        for event in decode_parallel(decode, contents, index, workers,
+                                     fields=fields, event_filter=event_filter, zero_copy=zero_copy,
+                                     records=records, int_arrays=int_arrays, buffer_class=buffer_class,
+                                     start_gameloop=start_gameloop, end_gameloop=end_gameloop):
+            yield event
+        return
+
+    options = {'zero_copy': zero_copy, 'records': records, 'int_arrays': int_arrays}
+    if buffer_class is not None:
+        options['buffer_class'] = buffer_class
+    if decoder_class is VersionedDecoder:
+        # long streams pay for inlining the structs of their events
+        options['inline'] = tuple(sorted(set(typeid for typeid, typename in event_types.itervalues())))
+
+    # With chunks, decoding starts on empty contents and a new decoder
+    # takes over the undecoded rest and the next chunk whenever the
+    # contents run out.
+    chunks = None
+    if hasattr(contents, 'next'):
+        if index is not None:
+            raise ValueError('an index cannot seek in contents read in chunks')
+        chunks, contents = contents, ''
+    decoder = decoder_class(contents, typeinfos, **options)
+    read_delta = _bind(decoder, decoder._compiler.int_value(svaruint32_typeid))
+    gameloop = 0
+    if index is not None and start_gameloop is not None:
+        gameloop, offset = _index_checkpoint(index, start_gameloop)
+        decoder.seek(offset)
+    while True:
+        if decoder.done():
+            if chunks is None:
+                break
+            contents = _read_chunk(contents, decoder.used_bits() / 8, chunks)
+            if contents is None:
+                break
+            decoder = decoder_class(contents, typeinfos, **options)
+            read_delta = _bind(decoder, decoder._compiler.int_value(svaruint32_typeid))
+        start_bits = decoder.used_bits()
+        event_gameloop = gameloop
+
+        try:
+            # decode the gameloop delta before each event
+            gameloop += read_delta()
+
+            # gameloops only increase, so no later event is in the window
+            if end_gameloop is not None and gameloop > end_gameloop:
+                break
+
+            # decode the userid before each event
+            if userid_typeid is not None:
+                userid = decoder.instance(userid_typeid)
+
+            # decode the event id
+            eventid = decoder.instance(eventid_typeid)
+            typeid, typename = event_types.get(eventid, (None, None))
+            if typeid is None:
+                raise CorruptedError('eventid(%d) at %s' % (eventid, decoder))
+
+            # skip events that were filtered out or are before the window
+            # without decoding them
+            if ((event_filter is not None and eventid not in event_filter) or
+                    (start_gameloop is not None and gameloop < start_gameloop)):
+                decoder.skip(typeid)
+                decoder.byte_align()
+                continue
+
+            # decode the event struct instance, or only the requested fields
+            event = decoder.instance(typeid, fields.get(typename) if fields else None)
+        except TruncatedError:
+            # an event cut off at the end of a chunk is decoded again with
+            # the next chunk appended
+            if chunks is None:
+                raise
+            contents = _read_chunk(contents, start_bits / 8, chunks)
+            if contents is None:
+                raise
+            decoder = decoder_class(contents, typeinfos, **options)
+            read_delta = _bind(decoder, decoder._compiler.int_value(svaruint32_typeid))
+            gameloop = event_gameloop
+            continue
+        event['_event'] = typename
+        event['_eventid'] = eventid
+
+        #  insert gameloop and userid
+        event['_gameloop'] = gameloop
+        if userid_typeid is not None:
+            event['_userid'] = userid
+
+        # the next event is byte aligned
+        decoder.byte_align()
+
+        # insert bits used in stream
+        event['_bits'] = decoder.used_bits() - start_bits
+
+        yield event
+
+
+def index_event_stream(decoder, eventid_typeid, event_types, svaruint32_typeid, userid_typeid=None,
+                       interval=960):
+    # Walks the event framing, skipping the events, and returns (gameloop,
+    # byte offset) checkpoints about interval gameloops apart (960 is a
+    # minute of game time). Events resume byte aligned at each offset with
+    # the gameloop before their delta. The checkpoints can be stored next to
+    # the replay, e.g. with marshal or json, and passed as the index for the
+    # same contents.
+    read_delta, read_userid, read_eventid, skips = _event_framing(
+        decoder, eventid_typeid, event_types, svaruint32_typeid, userid_typeid)
+    done = decoder._buffer.done
+    used_bits = decoder._buffer.used_bits
+    byte_align = decoder._buffer.byte_align
+    index = [(0, 0)]
+    gameloop = 0
+    while not done():
+        if gameloop - index[-1][0] >= interval:
+            index.append((gameloop, used_bits() / 8))
+        gameloop += read_delta()
+        if read_userid is not None:
+            read_userid()
+        eventid = read_eventid()
+        skip = skips.get(eventid)
+        if skip is None:
+            raise CorruptedError('eventid(%d) at %s' % (eventid, decoder))
+        skip[1]()
+        byte_align()
+    return index
+
+
+def scan_event_stream(decoder, eventid_typeid, event_types, svaruint32_typeid, userid_typeid=None):
+    # Walks the event framing, skipping the events, and returns event_counts
+    # and event_bytes per event name, the first_gameloop and last_gameloop of
+    # the stream and, for streams with userids, user_counts, the events per
+    # userid.
+    read_delta, read_userid, read_eventid, skips = _event_framing(
+        decoder, eventid_typeid, event_types, svaruint32_typeid, userid_typeid)
+    done = decoder._buffer.done
+    used_bits = decoder._buffer.used_bits
+    byte_align = decoder._buffer.byte_align
+    counts = {}
+    sizes = {}
+    users = {}
+    first_gameloop = None
+    gameloop = 0
+    while not done():
+        start_bits = used_bits()
+        gameloop += read_delta()
+        if first_gameloop is None:
+            first_gameloop = gameloop
+        if read_userid is not None:
+            userid = read_userid()
+            users[userid] = users.get(userid, 0) + 1
+        eventid = read_eventid()
+        skip = skips.get(eventid)
+        if skip is None:
+            raise CorruptedError('eventid(%d) at %s' % (eventid, decoder))
+        typename = skip[0]
+        skip[1]()
+        byte_align()
+        counts[typename] = counts.get(typename, 0) + 1
+        sizes[typename] = sizes.get(typename, 0) + (used_bits() - start_bits) / 8
+    stats = {
+        'event_counts': counts,
+        'event_bytes': sizes,
+        'first_gameloop': first_gameloop,
+        'last_gameloop': gameloop if first_gameloop is not None else None,
+    }
+    if userid_typeid is not None:
+        stats['user_counts'] = users
+    return stats
+
+
+def _event_framing(decoder, eventid_typeid, event_types, svaruint32_typeid, userid_typeid):
+    # Returns readers of the gameloop delta, userid (None without userids)
+    # and eventid as ints, and per eventid the event name and a skip of the
+    # event, all bound to the decoder's buffer.
+    compiler = decoder._compiler
+    read_userid = None
+    if userid_typeid is not None:
+        read_userid = _bind(decoder, compiler.int_value(userid_typeid))
+    skips = dict((eventid, (typename, _bind(decoder, compiler.skip(typeid))))
+                 for eventid, (typeid, typename) in event_types.iteritems())
+    return (_bind(decoder, compiler.int_value(svaruint32_typeid)), read_userid,
+            _bind(decoder, compiler.int_value(eventid_typeid)), skips)
+
+
+def _bind(decoder, compiled):
+    return functools.partial(compiled, decoder._buffer)
+
+
+def _read_chunk(contents, offset, chunks):
+    # Returns the contents from offset on with the next chunk appended, or
+    # None when the chunks are exhausted.
+    for chunk in chunks:
+        if chunk:
+            return contents[offset:] + chunk
+    return None
+
+
+def _index_checkpoint(index, start_gameloop):
+    # Returns the last checkpoint before start_gameloop. Every event before
+    # it has a gameloop at most the checkpoint's, so none is in the window.
+    checkpoint = index[0]
+    for entry in index:
+        if entry[0] >= start_gameloop:
+            break
+        checkpoint = entry
+    return checkpoint
+
+
+def _event_filter_ids(event_types, event_filter):
+    # Returns the eventids selected by a set of eventids and/or event names.
+    # Ids and names of no event, or a single name string, are a ValueError
+    # rather than a filter that silently selects nothing.
+    if isinstance(event_filter, basestring):
+        raise ValueError('event_filter(%r)' % (event_filter,))
+    eventids = dict((typename, eventid) for eventid, (typeid, typename) in event_types.iteritems())
+    selected = set()
+    for item in event_filter:
+        if item in event_types:
+            selected.add(item)
+        elif item in eventids:
+            selected.add(eventids[item])
+        else:
+            raise ValueError('event_filter(%r)' % (item,))
+    return selected
+
+
+def decode_parallel(decode, contents, index, workers, start_gameloop=None, end_gameloop=None, **options):
+    # Decodes an event stream on a pool of worker processes. decode is the
+    # protocol's decode_replay_*_events function and index its checkpoints for
+    # contents; the events between checkpoints are decoded as separate
+    # segments and yielded in stream order. workers is a process count or a
+    # multiprocessing pool to reuse.
+    if options.get('records') or options.get('zero_copy'):
+        raise ValueError('records and zero_copy results cannot be sent between processes')
+    if hasattr(contents, 'next'):
+        raise ValueError('contents read in chunks cannot be split between processes')
+    import multiprocessing
+    tasks = []
+    for gameloop, start, end, next_gameloop in _segments(index, len(contents), _workers_count(workers) * 4):
+        if end_gameloop is not None and gameloop > end_gameloop:
+            break
+        if start_gameloop is not None and next_gameloop is not None and next_gameloop < start_gameloop:
+            continue
+        segment = contents[start:end]
+        if isinstance(segment, memoryview):
+            segment = segment.tobytes()
+        elif not isinstance(segment, str):
+            segment = str(segment)
+        segment_options = dict(options)
+        if start_gameloop is not None:
+            segment_options['start_gameloop'] = start_gameloop - gameloop
+        if end_gameloop is not None:
+            segment_options['end_gameloop'] = end_gameloop - gameloop
+        tasks.append((decode, segment, gameloop, segment_options))
+    pool = multiprocessing.Pool(workers) if isinstance(workers, (int, long)) else workers
+    try:
+        for events in pool.imap(_decode_segment, tasks):
+            for event in events:
+                yield event
+    finally:
+        if pool is not workers:
+            pool.terminate()
+
+
+def _workers_count(workers):
+    if isinstance(workers, (int, long)):
+        return workers
+    import multiprocessing
+    return getattr(workers, '_processes', None) or multiprocessing.cpu_count()
+
+
+def _segments(index, size, count):
+    # Splits the stream at checkpoints into about count segments of similar
+    # byte size: (gameloop, start offset, end offset, next gameloop) where
+    # the gameloops are those before the first event of the segment and of
+    # the next one, None at the end of the stream.
+    target = max(size / max(count, 1), 1)
+    bounds = [index[0]]
+    for checkpoint in index[1:]:
+        if checkpoint[1] - bounds[-1][1] >= target:
+            bounds.append(checkpoint)
+    segments = []
+    for i, (gameloop, start) in enumerate(bounds):
+        if i + 1 < len(bounds):
+            segments.append((gameloop, start, bounds[i + 1][1], bounds[i + 1][0]))
+        else:
+            segments.append((gameloop, start, size, None))
+    return segments
+
+
+def _decode_segment(task):
+    # Runs in a worker: decodes a segment and rebases its gameloops, which
+    # restart from 0 in the segment's own decoder.
+    decode, segment, gameloop, options = task
+    events = list(decode(segment, **options))
+    for event in events:
+        event['_gameloop'] += gameloop
+    return events
+
+
+class AttributeTable(object):
+    # The attributes of a replay.attributes.events stream, unpacked in one
+    # struct call into columns instead of being read field by field. After
+    # a 9 byte preamble of source, map namespace and record count, every
+    # record is 13 little endian bytes: namespace, attrid, scope and a 4
+    # byte value stored reversed and null padded.
+    #
+    # The columns are array.array for the ints and a list of the values, or
+    # with columns='numpy' fields of one numpy structured array. Rows are
+    # found by (scope, attrid) through an index built on first lookup, and
+    # as_dict returns the dict that decode_replay_attributes_events builds.
+    _preamble = struct.Struct('<BII')
+    _record_size = 13
+
+    def __init__(self, contents, columns='array'):
+        if not AttributeTable.whole(contents):
+            raise TruncatedError('attributes(%d bytes)' % len(contents))
+        self.source, self.mapNamespace, self.count = self._preamble.unpack_from(contents)
+        rows = (len(contents) - self._preamble.size) / self._record_size
+        if columns == 'array':
+            fields = struct.unpack_from('<' + 'IIB4s' * rows, contents, self._preamble.size)
+            self.namespace = array.array('I', fields[0::4])
+            self.attrid = array.array('I', fields[1::4])
+            self.scope = array.array('B', fields[2::4])
+            self.value = [value[::-1].strip('\x00') for value in fields[3::4]]
+        elif columns == 'numpy':
+            import numpy
+            dtype = numpy.dtype([('namespace', '<u4'), ('attrid', '<u4'), ('scope', 'u1'), ('value', 'S4')])
+            records = numpy.frombuffer(contents, dtype, rows, self._preamble.size)
+            self.namespace = records['namespace']
+            self.attrid = records['attrid']
+            self.scope = records['scope']
+            self.value = numpy.array([value[::-1].strip('\x00') for value in records['value'].tolist()], 'S4')
+        else:
+            raise ValueError('columns(%r)' % (columns,))
+        self._index = None
+
+    @staticmethod
+    def whole(contents):
+        # Whether contents holds the preamble and only whole records.
+        size = len(contents) - AttributeTable._preamble.size
+        return size >= 0 and size % AttributeTable._record_size == 0
+
+    def __len__(self):
+        return len(self.value)
+
+    def row(self, i):
+        return {'namespace': int(self.namespace[i]),
+                'attrid': int(self.attrid[i]),
+                'value': str(self.value[i])}
+
+    def rows(self, scope, attrid):
+        # Returns the indexes of the rows of (scope, attrid), in stream order.
+        if self._index is None:
+            index = {}
+            for i, key in enumerate(zip(_ints(self.scope), _ints(self.attrid))):
+                index.setdefault(key, []).append(i)
+            self._index = index
+        return self._index.get((scope, attrid), [])
+
+    def lookup(self, scope, attrid):
+        # Returns the values of (scope, attrid), in stream order.
+        return [str(self.value[i]) for i in self.rows(scope, attrid)]
+
+    def as_dict(self):
+        scopes = {}
+        values = self.value if isinstance(self.value, list) else self.value.tolist()
+        for namespace, attrid, scope, value in zip(_ints(self.namespace), _ints(self.attrid),
+                                                   _ints(self.scope), values):
+            attrids = scopes.get(scope)
+            if attrids is None:
+                attrids = scopes[scope] = {}
+            rows = attrids.get(attrid)
+            if rows is None:
+                rows = attrids[attrid] = []
+            rows.append({'namespace': namespace, 'attrid': attrid, 'value': value})
+        return {'source': self.source, 'mapNamespace': self.mapNamespace, 'scopes': scopes}
+
 
-    def _skip_instance(self):
-        skip = self._buffer.read_bits(8)
-        if skip == 0:  # array
-            length = self._vint()
-            for i in xrange(length):
-                self._skip_instance()
-        elif skip == 1:  # bitblob
-            length = self._vint()
-            self._buffer.read_aligned_bytes((length + 7) / 8)
-        elif skip == 2:  # blob
-            length = self._vint()
-            self._buffer.read_aligned_bytes(length)
-        elif skip == 3:  # choice
-            tag = self._vint()
-            self._skip_instance()
-        elif skip == 4:  # optional
-            exists = self._buffer.read_bits(8) != 0
-            if exists:
-                self._skip_instance()
-        elif skip == 5:  # struct
-            length = self._vint()
-            for i in xrange(length):
-                tag = self._vint()
-                self._skip_instance()
-        elif skip == 6:  # u8
-            self._buffer.read_aligned_bytes(1)
-        elif skip == 7:  # u32
-            self._buffer.read_aligned_bytes(4)
-        elif skip == 8:  # u64
-            self._buffer.read_aligned_bytes(8)
-        elif skip == 9:  # vint
-            self._vint()
+def _ints(column):
+    # The values of an int column as ints, where array('I') and numpy would
+    # give longs that print with an L suffix.
+    return [int(value) for value in column.tolist()]
@@ -26,7 +26,7 @@ import pprint
 import json
 
 from mpyq import mpyq
-import protocol29406
+import registry
 
 class EventLogger:
     def __init__(self):
@@ -70,26 +70,28 @@ if __name__ == '__main__':
                         action="store_true")
     parser.add_argument("--stats", help="print stats",
                         action="store_true")
+    parser.add_argument("--scan", help="print event stats from the event framing, without decoding the events",
+                        action="store_true")
     parser.add_argument("--json", help="protocol information is printed in json format.",
                         action="store_true")
     args = parser.parse_args()
 
-    archive = mpyq.MPQArchive(args.replay_file)
+    archive = mpyq.MPQArchive(args.replay_file, listfile=False)
 
     logger = EventLogger()
     logger.args = args;
 
     # Read the protocol header, this can be read with any protocol
     contents = archive.header['user_data_header']['content']
-    header = protocol29406.decode_replay_header(contents)
+    header = registry.get_protocol(29406).decode_replay_header(contents)
     if args.header:
         logger.log(sys.stdout, header)
 
     # The header's baseBuild determines which protocol to use
     baseBuild = header['m_version']['m_baseBuild']
     try:
-        protocol = __import__('protocol%s' % (baseBuild,))
-    except:
+        protocol = registry.get_protocol(baseBuild)
+    except registry.UnsupportedBuildError:
         print >> sys.stderr, 'Unsupported base build: %d' % baseBuild
         sys.exit(1)
 
@@ -108,20 +110,20 @@ if __name__ == '__main__':
 
     # Print game events and/or game events stats
     if args.gameevents:
-        contents = archive.read_file('replay.game.events')
+        contents = archive.open_file('replay.game.events')
         for event in protocol.decode_replay_game_events(contents):
             logger.log(sys.stdout, event)
 
     # Print message events
     if args.messageevents:
-        contents = archive.read_file('replay.message.events')
+        contents = archive.open_file('replay.message.events')
         for event in protocol.decode_replay_message_events(contents):
             logger.log(sys.stdout, event)
 
     # Print tracker events
     if args.trackerevents:
         if hasattr(protocol, 'decode_replay_tracker_events'):
-            contents = archive.read_file('replay.tracker.events')
+            contents = archive.open_file('replay.tracker.events')
             for event in protocol.decode_replay_tracker_events(contents):
                 logger.log(sys.stdout, event)
 
@@ -131,6 +133,15 @@ if __name__ == '__main__':
         attributes = protocol.decode_replay_attributes_events(contents)
         logger.log(sys.stdout, attributes)
 
+    # Print event stats from the framing only
+    if args.scan:
+        for name in ('game', 'message', 'tracker'):
+            if hasattr(protocol, 'scan_replay_%s_events' % name):
+                contents = archive.read_file('replay.%s.events' % name)
+                stats = getattr(protocol, 'scan_replay_%s_events' % name)(contents)
+                stats['stream'] = name
+                logger.log(sys.stdout, stats)
+
     # Print stats
     if args.stats:
         logger.log_stats(sys.stderr)
@@ -0,0 +1,70 @@
+#
+# Fast access to a replay's metadata, for callers such as upload checks
+# that only need to know what a replay is before accepting it.
+#
+# The header is decoded from the MPQ user data header, which is read along
+# with the archive headers when the replay is opened. The details are read
+# from the archive only when asked for. The listfile is never read, and the
+# hash and block tables only once the details are.
+
+from mpyq import mpyq
+import registry
+
+
+class ReplayMetadata(object):
+    def __init__(self, replay_file):
+        # replay_file is a file name or a file object open for reading;
+        # files opened here are closed by close.
+        if hasattr(replay_file, 'read'):
+            self._file = replay_file
+            self._owned = False
+        else:
+            self._file = open(replay_file, 'rb')
+            self._owned = True
+        try:
+            self.archive = mpyq.MPQArchive(self._file, listfile=False)
+            contents = self.archive.header['user_data_header']['content']
+            self.header = registry.get_protocol(29406).decode_replay_header(contents)
+        except:
+            self.close()
+            raise
+        self.baseBuild = self.header['m_version']['m_baseBuild']
+        self.elapsedGameLoops = self.header['m_elapsedGameLoops']
+        self._details = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._owned:
+            self._file.close()
+
+    @property
+    def protocol(self):
+        # Raises registry.UnsupportedBuildError for unknown builds.
+        return registry.get_protocol(self.baseBuild)
+
+    def details(self, fields=None):
+        # Returns the game details, read and decoded on first use. fields
+        # optionally lists the dotted field paths to decode, as for
+        # decode_replay_details.
+        key = None if fields is None else frozenset(fields)
+        details = self._details.get(key)
+        if details is None:
+            contents = self.archive.read_file('replay.details')
+            details = self.protocol.decode_replay_details(contents, fields)
+            self._details[key] = details
+        return details
+
+
+def read_metadata(replay_file, details=True):
+    # Returns the header and, unless details is false, the details of the
+    # replay as a dict, closing the file before returning.
+    with ReplayMetadata(replay_file) as metadata:
+        result = {'header': metadata.header}
+        if details:
+            result['details'] = metadata.details()
+        return result
@@ -6,7 +6,7 @@ mpyq is a Python library for reading MPQ (MoPaQ) archives.
 """
 
 import bz2
-import cStringIO
+import mmap
 import os
 import struct
 import zlib
@@ -82,54 +82,147 @@ MPQBlockTableEntry = namedtuple('MPQBlockTableEntry',
 MPQBlockTableEntry.struct_format = '4I'
 
 
+class MPQFile(object):
+    """A file in a MPQ archive, decompressed one sector at a time.
+
+    read() works as on a file object. Iterating yields the rest of the
+    file in chunks of chunk_size bytes, which the heroprotocol decoders
+    consume as they go.
+    """
+
+    def __init__(self, sectors, chunk_size=65536):
+        self._sectors = sectors
+        self._data = ''
+        self.chunk_size = chunk_size
+        self.closed = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        """Return the next chunk_size bytes, fewer at the end of the file."""
+        data = self.read(self.chunk_size)
+        if not data:
+            raise StopIteration
+        return data
+
+    def read(self, size=-1):
+        """Read up to size bytes, or the rest of the file."""
+        chunks = [self._data]
+        length = len(self._data)
+        if size < 0 or length < size:
+            for sector in self._sectors:
+                chunks.append(sector)
+                length += len(sector)
+                if 0 <= size <= length:
+                    break
+        data = ''.join(chunks)
+        if size < 0:
+            size = len(data)
+        self._data = data[size:]
+        return data[:size]
+
+    def close(self):
+        self._sectors = iter(())
+        self._data = ''
+        self.closed = True
+
+
 class MPQArchive(object):
 
-    def __init__(self, filename, listfile=True):
+    def __init__(self, filename, listfile=True, use_mmap=False):
         """Create a MPQArchive object.
 
         You can skip reading the listfile if you pass listfile=False
         to the constructor. The 'files' attribute will be unavailable
         if you do this.
+
+        The hash and block tables are read on first use, so an archive
+        opened without the listfile reads only its headers until a file
+        is read from it.
+
+        With use_mmap=True the archive is memory mapped. The headers,
+        tables and sector offsets are unpacked and compressed sectors
+        decompressed straight from the mapping instead of being read
+        with seek() and read(); only uncompressed file data is copied,
+        into the strings returned. One such archive can serve read_file
+        calls from several threads at once.
         """
         if hasattr(filename, 'read'):
             self.file = filename
         else:
             self.file = open(filename, 'rb')
+        if use_mmap:
+            self.mapping = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self.mapping = None
         self.header = self.read_header()
-        self.hash_table = self.read_table('hash')
-        self.block_table = self.read_table('block')
+        self._hash_table = None
+        self._hash_index = None
+        self._block_table = None
         if listfile:
             self.files = self.read_file('(listfile)').splitlines()
         else:
             self.files = None
 
+    @property
+    def hash_table(self):
+        """The hash table, read on first use."""
+        if self._hash_table is None:
+            self._hash_table = self.read_table('hash')
+        return self._hash_table
+
+    @property
+    def block_table(self):
+        """The block table, read on first use."""
+        if self._block_table is None:
+            self._block_table = self.read_table('block')
+        return self._block_table
+
+    def close(self):
+        """Close the mapping, if any, and the archive file."""
+        if self.mapping is not None:
+            self.mapping.close()
+        self.file.close()
+
+    def pread(self, offset, size):
+        """Read size bytes at offset in the archive file.
+
+        In mmap mode this is a zero-copy buffer view of the mapping,
+        which does not move any file position and so is safe from several
+        threads. Callers unpack and decompress the view in place; only the
+        strings returned to users, such as uncompressed sectors, are
+        copied out of it.
+        """
+        if self.mapping is not None:
+            return buffer(self.mapping, offset, size)
+        self.file.seek(offset)
+        return self.file.read(size)
+
     def read_header(self):
         """Read the header of a MPQ archive."""
 
-        def read_mpq_header(offset=None):
-            if offset:
-                self.file.seek(offset)
-            data = self.file.read(32)
+        def read_mpq_header(offset=0):
+            data = self.pread(offset, 32)
             header = MPQFileHeader._make(
                 struct.unpack(MPQFileHeader.struct_format, data))
             header = header._asdict()
             if header['format_version'] == 1:
-                data = self.file.read(12)
+                data = self.pread(offset + 32, 12)
                 extended_header = MPQFileHeaderExt._make(
                     struct.unpack(MPQFileHeaderExt.struct_format, data))
                 header.update(extended_header._asdict())
             return header
 
         def read_mpq_user_data_header():
-            data = self.file.read(16)
+            data = self.pread(0, 16)
             header = MPQUserDataHeader._make(
                 struct.unpack(MPQUserDataHeader.struct_format, data))
             header = header._asdict()
-            header['content'] = self.file.read(header['user_data_header_size'])
+            header['content'] = str(self.pread(16, header['user_data_header_size']))
             return header
 
-        magic = self.file.read(4)
-        self.file.seek(0)
+        magic = str(self.pread(0, 4))
 
         if magic == 'MPQ\x1a':
             header = read_mpq_header()
@@ -156,27 +249,45 @@ class MPQArchive(object):
         table_entries = self.header['%s_table_entries' % table_type]
         key = self._hash('(%s table)' % table_type, 'TABLE')
 
-        self.file.seek(table_offset + self.header['offset'])
-        data = self.file.read(table_entries * 16)
+        data = self.pread(table_offset + self.header['offset'], table_entries * 16)
         data = self._decrypt(data, key)
 
         def unpack_entry(position):
-            entry_data = data[position*16:position*16+16]
             return entry_class._make(
-                struct.unpack(entry_class.struct_format, entry_data))
+                struct.unpack_from(entry_class.struct_format, data, position*16))
 
         return [unpack_entry(i) for i in range(table_entries)]
 
     def get_hash_table_entry(self, filename):
-        """Get the hash table entry corresponding to a given filename."""
+        """Get the hash table entry corresponding to a given filename.
+
+        Entries are looked up in a dict keyed by (hash_a, hash_b), built
+        on first use, where the first entry in table order wins as it did
+        with a scan of the table.
+        """
+        if self._hash_index is None:
+            index = {}
+            for entry in self.hash_table:
+                index.setdefault((entry.hash_a, entry.hash_b), entry)
+            self._hash_index = index
         hash_a = self._hash(filename, 'HASH_A')
         hash_b = self._hash(filename, 'HASH_B')
-        for entry in self.hash_table:
-            if (entry.hash_a == hash_a and entry.hash_b == hash_b):
-                return entry
+        return self._hash_index.get((hash_a, hash_b))
 
     def read_file(self, filename, force_decompress=False):
         """Read a file from the MPQ archive."""
+        sectors = self.read_file_sectors(filename, force_decompress)
+        if sectors is None:
+            return None
+        return ''.join(sectors)
+
+    def read_file_sectors(self, filename, force_decompress=False):
+        """Return an iterator over the decompressed sectors of a file.
+
+        Each sector is only decompressed when the iterator reaches it, so
+        readers that stop early skip decompressing the rest of the file.
+        Returns None where read_file would.
+        """
 
         def decompress(data):
             """Read the compression type and decompress file data."""
@@ -184,12 +295,25 @@ class MPQArchive(object):
             if compression_type == 0:
                 return data
             elif compression_type == 2:
-                return zlib.decompress(data[1:], 15)
+                return zlib.decompress(buffer(data, 1), 15)
             elif compression_type == 16:
-                return bz2.decompress(data[1:])
+                return bz2.decompress(buffer(data, 1))
             else:
                 raise RuntimeError("Unsupported compression type.")
 
+        def read_block(offset, size, start, end):
+            """Read the block data from start to end, cut to its size."""
+            start = min(max(start, 0), size)
+            end = min(max(end, start), size)
+            return self.pread(offset + start, end - start)
+
+        def iter_sectors(offset, size, positions, compressed):
+            for i in range(len(positions) - 1):
+                sector = read_block(offset, size, positions[i], positions[i+1])
+                if compressed:
+                    sector = decompress(sector)
+                yield sector if isinstance(sector, str) else str(sector)
+
         hash_entry = self.get_hash_table_entry(filename)
         if hash_entry is None:
             return None
@@ -200,13 +324,17 @@ class MPQArchive(object):
             if block_entry.archived_size == 0:
                 return None
 
+            # Sectors are read from the archive only as the iterator
+            # reaches them.
             offset = block_entry.offset + self.header['offset']
-            self.file.seek(offset)
-            file_data = self.file.read(block_entry.archived_size)
+            size = block_entry.archived_size
 
             if block_entry.flags & MPQ_FILE_ENCRYPTED:
                 raise NotImplementedError("Encryption is not supported yet.")
 
+            compressed = (block_entry.flags & MPQ_FILE_COMPRESS and
+                (force_decompress or block_entry.size > block_entry.archived_size))
+
             if not block_entry.flags & MPQ_FILE_SINGLE_UNIT:
                 # File consist of many sectors. They all need to be
                 # decompressed separately and united.
@@ -217,24 +345,27 @@ class MPQArchive(object):
                     sectors += 1
                 else:
                     crc = False
-                positions = struct.unpack('<%dI' % (sectors + 1),
-                                          file_data[:4*(sectors+1)])
-                result = cStringIO.StringIO()
-                for i in range(len(positions) - (2 if crc else 1)):
-                    sector = file_data[positions[i]:positions[i+1]]
-                    if (block_entry.flags & MPQ_FILE_COMPRESS and
-                        (force_decompress or block_entry.size > block_entry.archived_size)):
-                        sector = decompress(sector)
-                    result.write(sector)
-                file_data = result.getvalue()
+                positions = struct.unpack_from('<%dI' % (sectors + 1),
+                                               read_block(offset, size, 0, 4*(sectors+1)))
+                if crc:
+                    positions = positions[:-1]
+                return iter_sectors(offset, size, positions, compressed)
             else:
                 # Single unit files only need to be decompressed, but
                 # compression only happens when at least one byte is gained.
-                if (block_entry.flags & MPQ_FILE_COMPRESS and
-                    (force_decompress or block_entry.size > block_entry.archived_size)):
-                    file_data = decompress(file_data)
+                return iter_sectors(offset, size, (0, size), compressed)
+
+    def open_file(self, filename, force_decompress=False, chunk_size=65536):
+        """Open a file in the MPQ archive as a file-like MPQFile.
 
-            return file_data
+        The file is read and decompressed a sector at a time, as it is
+        read from the MPQFile, so only the sectors of about one chunk are
+        held in memory at once. Returns None where read_file would.
+        """
+        sectors = self.read_file_sectors(filename, force_decompress)
+        if sectors is None:
+            return None
+        return MPQFile(sectors, chunk_size)
 
     def extract(self):
         """Extract all the files inside the MPQ archive in memory."""
@@ -306,48 +437,48 @@ class MPQArchive(object):
                                                         width=width)
 
     def _hash(self, string, hash_type):
-        """Hash a string using MPQ's hash function."""
-        hash_types = {
-            'TABLE_OFFSET': 0,
-            'HASH_A': 1,
-            'HASH_B': 2,
-            'TABLE': 3
-        }
-        seed1 = 0x7FED7FED
-        seed2 = 0xEEEEEEEE
+        """Hash a string using MPQ's hash function.
 
-        for ch in string:
-            ch = ord(ch.upper())
-            value = self.encryption_table[(hash_types[hash_type] << 8) + ch]
-            seed1 = (value ^ (seed1 + seed2)) & 0xFFFFFFFF
-            seed2 = ch + seed1 + seed2 + (seed2 << 5) + 3 & 0xFFFFFFFF
-
-        return seed1
+        Hashes are memoized, and those of the files every replay has and
+        of the table keys are computed when the module is loaded.
+        """
+        hashed = _hashes.get((string, hash_type))
+        if hashed is None:
+            hashed = hash_string(string, hash_type)
+            if len(_hashes) >= HASH_CACHE_SIZE:
+                _hashes.clear()
+                _hashes.update(_known_hashes)
+            _hashes[(string, hash_type)] = hashed
+        return hashed
 
     def _decrypt(self, data, key):
-        """Decrypt hash or block table or a sector."""
+        """Decrypt hash or block table or a sector.
+
+        The data is unpacked and packed with one struct call each. Every
+        step of the keystream depends on the previous decrypted value, so
+        the loop itself has to stay sequential.
+        """
+        encryption_table = self.encryption_table
+        count = len(data) // 4
+        values = list(struct.unpack_from('<%dI' % count, data))
         seed1 = key
         seed2 = 0xEEEEEEEE
-        result = cStringIO.StringIO()
 
-        for i in range(len(data) // 4):
-            seed2 += self.encryption_table[0x400 + (seed1 & 0xFF)]
-            seed2 &= 0xFFFFFFFF
-            value = struct.unpack("<I", data[i*4:i*4+4])[0]
-            value = (value ^ (seed1 + seed2)) & 0xFFFFFFFF
+        for i in xrange(count):
+            seed2 = seed2 + encryption_table[0x400 + (seed1 & 0xFF)] & 0xFFFFFFFF
+            value = (values[i] ^ (seed1 + seed2)) & 0xFFFFFFFF
+            values[i] = value
 
             seed1 = ((~seed1 << 0x15) + 0x11111111) | (seed1 >> 0x0B)
             seed1 &= 0xFFFFFFFF
             seed2 = value + seed2 + (seed2 << 5) + 3 & 0xFFFFFFFF
 
-            result.write(struct.pack("<I", value))
-
-        return result.getvalue()
+        return struct.pack('<%dI' % count, *values)
 
     def _prepare_encryption_table():
         """Prepare encryption table for MPQ hash function."""
         seed = 0x00100001
-        crypt_table = {}
+        crypt_table = [0] * 0x500
 
         for i in range(256):
             index = i
@@ -367,6 +498,47 @@ class MPQArchive(object):
     encryption_table = _prepare_encryption_table()
 
 
+HASH_TYPES = {
+    'TABLE_OFFSET': 0,
+    'HASH_A': 1,
+    'HASH_B': 2,
+    'TABLE': 3
+}
+
+# Hashes of the files found in every replay, and of the table keys.
+KNOWN_FILES = ('(listfile)', 'replay.details', 'replay.initData',
+               'replay.game.events', 'replay.message.events',
+               'replay.tracker.events', 'replay.attributes.events')
+KNOWN_TABLES = ('(hash table)', '(block table)')
+
+# Memoized hashes are dropped, except the known ones, once there are this
+# many of them.
+HASH_CACHE_SIZE = 4096
+
+
+def hash_string(string, hash_type):
+    """Hash a string using MPQ's hash function, without memoizing."""
+    encryption_table = MPQArchive.encryption_table
+    offset = HASH_TYPES[hash_type] << 8
+    seed1 = 0x7FED7FED
+    seed2 = 0xEEEEEEEE
+
+    for ch in string.upper():
+        ch = ord(ch)
+        value = encryption_table[offset + ch]
+        seed1 = (value ^ (seed1 + seed2)) & 0xFFFFFFFF
+        seed2 = ch + seed1 + seed2 + (seed2 << 5) + 3 & 0xFFFFFFFF
+
+    return seed1
+
+
+_known_hashes = dict(
+    [((name, hash_type), hash_string(name, hash_type))
+     for name in KNOWN_FILES for hash_type in ('HASH_A', 'HASH_B')] +
+    [((name, 'TABLE'), hash_string(name, 'TABLE')) for name in KNOWN_TABLES])
+_hashes = dict(_known_hashes)
+
+
 def main():
     import argparse
     description = "mpyq reads and extracts MPQ archives."
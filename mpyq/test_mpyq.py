@@ -0,0 +1,291 @@
+#
+# Checks MPQArchive against the original per-dword and per-character
+# hashing and decryption, on archives written by a small MPQ writer.
+#
+# Run from this directory with: python -m unittest test_mpyq
+#
+
+import os
+import random
+import shutil
+import struct
+import tempfile
+from cStringIO import StringIO
+import unittest
+import zlib
+
+import mpyq
+from mpyq import MPQArchive, MPQFile
+
+
+def reference_encryption_table():
+    # the original crypt table, a dict
+    seed = 0x00100001
+    crypt_table = {}
+    for i in range(256):
+        index = i
+        for j in range(5):
+            seed = (seed * 125 + 3) % 0x2AAAAB
+            temp1 = (seed & 0xFFFF) << 0x10
+            seed = (seed * 125 + 3) % 0x2AAAAB
+            temp2 = (seed & 0xFFFF)
+            crypt_table[index] = (temp1 | temp2)
+            index += 0x100
+    return crypt_table
+
+REFERENCE_TABLE = reference_encryption_table()
+
+
+def reference_hash(string, hash_type):
+    # the original hash, one character at a time
+    hash_types = {'TABLE_OFFSET': 0, 'HASH_A': 1, 'HASH_B': 2, 'TABLE': 3}
+    seed1 = 0x7FED7FED
+    seed2 = 0xEEEEEEEE
+    for ch in string:
+        ch = ord(ch.upper())
+        value = REFERENCE_TABLE[(hash_types[hash_type] << 8) + ch]
+        seed1 = (value ^ (seed1 + seed2)) & 0xFFFFFFFF
+        seed2 = ch + seed1 + seed2 + (seed2 << 5) + 3 & 0xFFFFFFFF
+    return seed1
+
+
+def reference_decrypt(data, key):
+    # the original decryption, one dword at a time
+    seed1 = key
+    seed2 = 0xEEEEEEEE
+    result = []
+    for i in range(len(data) // 4):
+        seed2 += REFERENCE_TABLE[0x400 + (seed1 & 0xFF)]
+        seed2 &= 0xFFFFFFFF
+        value = struct.unpack("<I", data[i*4:i*4+4])[0]
+        value = (value ^ (seed1 + seed2)) & 0xFFFFFFFF
+        seed1 = ((~seed1 << 0x15) + 0x11111111) | (seed1 >> 0x0B)
+        seed1 &= 0xFFFFFFFF
+        seed2 = value + seed2 + (seed2 << 5) + 3 & 0xFFFFFFFF
+        result.append(struct.pack("<I", value))
+    return ''.join(result)
+
+
+def encrypt(data, key):
+    # the inverse of reference_decrypt
+    seed1 = key
+    seed2 = 0xEEEEEEEE
+    result = []
+    for i in range(len(data) // 4):
+        seed2 = seed2 + REFERENCE_TABLE[0x400 + (seed1 & 0xFF)] & 0xFFFFFFFF
+        value = struct.unpack("<I", data[i*4:i*4+4])[0]
+        result.append(struct.pack("<I", (value ^ (seed1 + seed2)) & 0xFFFFFFFF))
+        seed1 = ((~seed1 << 0x15) + 0x11111111) | (seed1 >> 0x0B)
+        seed1 &= 0xFFFFFFFF
+        seed2 = value + seed2 + (seed2 << 5) + 3 & 0xFFFFFFFF
+    return ''.join(result)
+
+
+def random_bytes(rng, size):
+    return ''.join(chr(rng.randrange(256)) for i in xrange(size))
+
+
+def random_file(rng, size):
+    # random bytes, or compressible ones half of the time
+    if rng.randrange(2):
+        return random_bytes(rng, size)
+    return ''.join(rng.choice(['event', 'unit', '\x00\x00\x00']) for i in xrange(size))[:size]
+
+
+def with_positions(sectors):
+    # sectors behind the table of their offsets
+    positions = [4 * (len(sectors) + 1)]
+    for sector in sectors:
+        positions.append(positions[-1] + len(sector))
+    return struct.pack('<%dI' % len(positions), *positions) + ''.join(sectors)
+
+
+def write_archive(path, files, sector_size_shift=0, duplicates=()):
+    # Writes an MPQ archive, behind a user data header, holding files, a
+    # list of (name, data). The listfile is stored as a single unit and the
+    # other files in sectors, zlib compressed where that makes the file
+    # smaller, and as many of them as mpyq expects: one more than the whole
+    # sectors in the file. duplicates names files whose hash entry is
+    # repeated later in the hash table, pointing at the block of the next
+    # file.
+    sector_size = 512 << sector_size_shift
+    entries = [('(listfile)', '\r\n'.join(name for name, data in files))] + list(files)
+    body = []
+    blocks = []
+    offset = 32
+    for i, (name, data) in enumerate(entries):
+        if i == 0:
+            stored = data
+            flags = mpyq.MPQ_FILE_EXISTS | mpyq.MPQ_FILE_SINGLE_UNIT
+        else:
+            sectors = [data[j:j + sector_size] for j in xrange(0, len(data) + 1, sector_size)]
+            stored = with_positions(sectors)
+            flags = mpyq.MPQ_FILE_EXISTS
+            compressed = with_positions(['\x02' + zlib.compress(sector) for sector in sectors])
+            if len(compressed) < len(data):
+                stored = compressed
+                flags |= mpyq.MPQ_FILE_COMPRESS
+        blocks.append((offset, len(stored), len(data), flags))
+        body.append(stored)
+        offset += len(stored)
+    size = 1
+    while size < 2 * (len(entries) + len(duplicates)):
+        size *= 2
+    table = [(0xFFFFFFFF, 0xFFFFFFFF, 0xFFFF, 0xFFFF, 0xFFFFFFFF)] * size
+    def insert(name, block):
+        position = reference_hash(name, 'TABLE_OFFSET') & (size - 1)
+        while table[position][4] != 0xFFFFFFFF:
+            position = (position + 1) & (size - 1)
+        table[position] = (reference_hash(name, 'HASH_A'), reference_hash(name, 'HASH_B'), 0, 0, block)
+    for i, (name, data) in enumerate(entries):
+        insert(name, i)
+    for name in duplicates:
+        insert(name, (zip(*entries)[0].index(name) + 1) % len(entries))
+    hash_table = encrypt(''.join(struct.pack('<2I2HI', *entry) for entry in table),
+                         reference_hash('(hash table)', 'TABLE'))
+    block_table = encrypt(''.join(struct.pack('<4I', *block) for block in blocks),
+                          reference_hash('(block table)', 'TABLE'))
+    archive = ''.join(body)
+    header = struct.pack('<4s2I2H4I', 'MPQ\x1a', 32, 32 + len(archive) + len(hash_table) + len(block_table),
+                         0, sector_size_shift, 32 + len(archive), 32 + len(archive) + len(hash_table),
+                         size, len(blocks))
+    user_data = struct.pack('<4s3I', 'MPQ\x1b', 512 - 16, 512, 4) + 'user'
+    with open(path, 'wb') as f:
+        f.write(user_data.ljust(512, '\x00') + header + archive + hash_table + block_table)
+
+
+class ArchiveTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def archive(self, files, **options):
+        path = os.path.join(self.directory, 'test.mpq')
+        write_archive(path, files, **options)
+        return path
+
+
+class HashTableTest(ArchiveTestCase):
+    def test_lookup(self):
+        # files are found through the dict as by a scan of the table, where
+        # the first of repeated entries wins
+        rng = random.Random(0)
+        files = [('file%d' % i, random_file(rng, rng.randrange(2000))) for i in xrange(20)]
+        duplicates = [name for name, data in rng.sample(files, 5)]
+        archive = MPQArchive(self.archive(files, duplicates=duplicates))
+        blocks = ['\r\n'.join(name for name, data in files)] + [data for name, data in files]
+        for name, data in files:
+            hash_a = reference_hash(name, 'HASH_A')
+            hash_b = reference_hash(name, 'HASH_B')
+            entries = [e for e in archive.hash_table if e.hash_a == hash_a and e.hash_b == hash_b]
+            self.assertEqual(len(entries), 2 if name in duplicates else 1)
+            self.assertEqual(archive.get_hash_table_entry(name), entries[0])
+            self.assertEqual(archive.read_file(name), blocks[entries[0].block_table_index])
+        self.assertEqual(archive.files, [name for name, data in files])
+        self.assertEqual(archive.get_hash_table_entry('missing'), None)
+        self.assertEqual(archive.read_file('missing'), None)
+        archive.close()
+
+
+
+class HashTest(unittest.TestCase):
+    def test_encryption_table(self):
+        table = MPQArchive.encryption_table
+        self.assertEqual(len(table), len(REFERENCE_TABLE))
+        self.assertEqual(dict(enumerate(table)), REFERENCE_TABLE)
+
+    def test_hash_string(self):
+        rng = random.Random(1)
+        for i in xrange(2000):
+            string = random_bytes(rng, rng.randrange(40))
+            for hash_type in mpyq.HASH_TYPES:
+                self.assertEqual(mpyq.hash_string(string, hash_type), reference_hash(string, hash_type),
+                                 (string, hash_type))
+
+    def test_memoized(self):
+        # the memoized hashes stay right when the cache is reset, and the
+        # known ones survive the reset
+        rng = random.Random(2)
+        archive = MPQArchive.__new__(MPQArchive)
+        size = mpyq.HASH_CACHE_SIZE
+        mpyq.HASH_CACHE_SIZE = len(mpyq._known_hashes) + 10
+        try:
+            for i in xrange(100):
+                string = rng.choice(['replay.Details', '(listfile)', random_bytes(rng, rng.randrange(20))])
+                hash_type = rng.choice(sorted(mpyq.HASH_TYPES))
+                self.assertEqual(archive._hash(string, hash_type), reference_hash(string, hash_type))
+                self.assertTrue(len(mpyq._hashes) <= mpyq.HASH_CACHE_SIZE)
+                for key, value in mpyq._known_hashes.iteritems():
+                    self.assertEqual(mpyq._hashes[key], value)
+        finally:
+            mpyq.HASH_CACHE_SIZE = size
+        for key, value in mpyq._known_hashes.iteritems():
+            self.assertEqual(value, reference_hash(*key))
+
+
+class DecryptTest(unittest.TestCase):
+    def test_decrypt(self):
+        # including lengths that are not whole dwords, whose tail is dropped
+        rng = random.Random(3)
+        archive = MPQArchive.__new__(MPQArchive)
+        for i in xrange(500):
+            data = random_bytes(rng, rng.choice([0, 3, 4, 16, rng.randrange(200)]))
+            key = rng.choice([0, 0xFFFFFFFF, rng.getrandbits(32)])
+            self.assertEqual(archive._decrypt(data, key), reference_decrypt(data, key), (data, key))
+            self.assertEqual(encrypt(archive._decrypt(data, key), key), data[:len(data) // 4 * 4])
+
+
+class MPQFileTest(ArchiveTestCase):
+    def test_read(self):
+        # reads of any size, across sector boundaries and past the end,
+        # return what a file object over the whole data would
+        rng = random.Random(4)
+        for i in xrange(300):
+            sectors = [random_bytes(rng, rng.choice([0, 1, 7, 512])) for j in xrange(rng.randrange(6))]
+            data = ''.join(sectors)
+            reference = StringIO(data)
+            f = MPQFile(iter(sectors), chunk_size=rng.choice([1, 5, 600]))
+            for j in xrange(8):
+                size = rng.choice([-1, 0, 1, 3, 511, 512, 513, 2000])
+                self.assertEqual(f.read(size), reference.read(size), (sectors, size))
+            self.assertEqual(f.read(), reference.read())
+            self.assertEqual(f.read(0), '')
+            self.assertEqual(f.read(10), '')
+
+    def test_iterate(self):
+        rng = random.Random(5)
+        for i in xrange(100):
+            sectors = [random_bytes(rng, rng.choice([0, 1, 7, 512])) for j in xrange(rng.randrange(6))]
+            data = ''.join(sectors)
+            chunk_size = rng.choice([1, 5, 600])
+            f = MPQFile(iter(sectors), chunk_size)
+            head = f.read(rng.randrange(10))
+            chunks = list(f)
+            self.assertEqual(head + ''.join(chunks), data)
+            self.assertTrue(all(len(chunk) == chunk_size for chunk in chunks[:-1]))
+            self.assertTrue(all(chunks))
+            self.assertEqual(f.read(), '')
+            f.close()
+            self.assertTrue(f.closed)
+
+    def test_open_file(self):
+        # files read sector by sector, from files and mappings, equal
+        # read_file
+        rng = random.Random(6)
+        files = [('file%d' % i, random_file(rng, rng.choice([0, 511, 512, 513, rng.randrange(5000)])))
+                 for i in xrange(10)]
+        path = self.archive(files)
+        for use_mmap in (False, True):
+            archive = MPQArchive(path, use_mmap=use_mmap)
+            for name, data in files:
+                self.assertEqual(archive.read_file(name), data)
+                self.assertEqual(''.join(archive.read_file_sectors(name)), data)
+                f = archive.open_file(name, chunk_size=100)
+                self.assertEqual(f.read(150) + ''.join(f), data)
+            self.assertEqual(archive.open_file('missing'), None)
+            archive.close()
+
+if __name__ == '__main__':
+    unittest.main()
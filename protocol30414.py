@@ -363,102 +363,91 @@ game_details_typeid = 39
 replay_initdata_typeid = 67
 
 
-def _varuint32_value(value):
-    # Returns the numeric value from a SVarUint32 instance.
-    for k,v in value.iteritems():
-        return v
-    return 0
+def decode_replay_game_events(contents, **options):
+    """Decodes and yields each game event from the contents byte string."""
+    return decode_event_stream(decode_replay_game_events, contents, BitPackedDecoder, typeinfos,
+                               game_eventid_typeid, game_event_types,
+                               svaruint32_typeid, replay_userid_typeid, **options)
 
 
-def _decode_event_stream(decoder, eventid_typeid, event_types, decode_user_id):
-    # Decodes events prefixed with a gameloop and possibly userid
-    gameloop = 0
-    while not decoder.done():
-        start_bits = decoder.used_bits()
+def scan_replay_game_events(contents):
+    """Returns statistics of the game events in the contents byte string."""
+    return scan_event_stream(BitPackedDecoder(contents, typeinfos),
+                             game_eventid_typeid, game_event_types,
+                             svaruint32_typeid, replay_userid_typeid)
 
-        # decode the gameloop delta before each event
-        delta = _varuint32_value(decoder.instance(svaruint32_typeid))
-        gameloop += delta
 
-        # decode the userid before each event
-        if decode_user_id:
-            userid = decoder.instance(replay_userid_typeid)
+def index_replay_game_events(contents, interval=960):
+    """Returns seek checkpoints for the game events in the contents byte string."""
+    return index_event_stream(BitPackedDecoder(contents, typeinfos),
+                              game_eventid_typeid, game_event_types,
+                              svaruint32_typeid, replay_userid_typeid, interval)
 
-        # decode the event id
-        eventid = decoder.instance(eventid_typeid)
-        typeid, typename = event_types.get(eventid, (None, None))
-        if typeid is None:
-            raise CorruptedError('eventid(%d) at %s' % (eventid, decoder))
 
-        # decode the event struct instance
-        event = decoder.instance(typeid)
-        event['_event'] = typename
-        event['_eventid'] = eventid
+def decode_replay_message_events(contents, **options):
+    """Decodes and yields each message event from the contents byte string."""
+    return decode_event_stream(decode_replay_message_events, contents, BitPackedDecoder, typeinfos,
+                               message_eventid_typeid, message_event_types,
+                               svaruint32_typeid, replay_userid_typeid, **options)
 
-        #  insert gameloop and userid
-        event['_gameloop'] = gameloop
-        if decode_user_id:
-            event['_userid'] = userid
 
-        # the next event is byte aligned
-        decoder.byte_align()
+def scan_replay_message_events(contents):
+    """Returns statistics of the message events in the contents byte string."""
+    return scan_event_stream(BitPackedDecoder(contents, typeinfos),
+                             message_eventid_typeid, message_event_types,
+                             svaruint32_typeid, replay_userid_typeid)
 
-        # insert bits used in stream
-        event['_bits'] = decoder.used_bits() - start_bits
 
-        yield event
+def index_replay_message_events(contents, interval=960):
+    """Returns seek checkpoints for the message events in the contents byte string."""
+    return index_event_stream(BitPackedDecoder(contents, typeinfos),
+                              message_eventid_typeid, message_event_types,
+                              svaruint32_typeid, replay_userid_typeid, interval)
 
 
-def decode_replay_game_events(contents):
-    """Decodes and yields each game event from the contents byte string."""
-    decoder = BitPackedDecoder(contents, typeinfos)
-    for event in _decode_event_stream(decoder,
-                                      game_eventid_typeid,
-                                      game_event_types,
-                                      decode_user_id=True):
-        yield event
+def decode_replay_tracker_events(contents, **options):
+    """Decodes and yields each tracker event from the contents byte string."""
+    return decode_event_stream(decode_replay_tracker_events, contents, VersionedDecoder, typeinfos,
+                               tracker_eventid_typeid, tracker_event_types,
+                               svaruint32_typeid, None, **options)
 
 
-def decode_replay_message_events(contents):
-    """Decodes and yields each message event from the contents byte string."""
-    decoder = BitPackedDecoder(contents, typeinfos)
-    for event in _decode_event_stream(decoder,
-                                      message_eventid_typeid,
-                                      message_event_types,
-                                      decode_user_id=True):
-        yield event
+def scan_replay_tracker_events(contents):
+    """Returns statistics of the tracker events in the contents byte string."""
+    return scan_event_stream(VersionedDecoder(contents, typeinfos),
+                             tracker_eventid_typeid, tracker_event_types,
+                             svaruint32_typeid, None)
 
 
-def decode_replay_tracker_events(contents):
-    """Decodes and yields each tracker event from the contents byte string."""
-    decoder = VersionedDecoder(contents, typeinfos)
-    for event in _decode_event_stream(decoder,
-                                      tracker_eventid_typeid,
-                                      tracker_event_types,
-                                      decode_user_id=False):
-        yield event
+def index_replay_tracker_events(contents, interval=960):
+    """Returns seek checkpoints for the tracker events in the contents byte string."""
+    return index_event_stream(VersionedDecoder(contents, typeinfos),
+                              tracker_eventid_typeid, tracker_event_types,
+                              svaruint32_typeid, None, interval)
 
 
-def decode_replay_header(contents):
+def decode_replay_header(contents, zero_copy=False):
     """Decodes and return the replay header from the contents byte string."""
-    decoder = VersionedDecoder(contents, typeinfos)
+    decoder = VersionedDecoder(contents, typeinfos, zero_copy=zero_copy)
     return decoder.instance(replay_header_typeid)
 
 
-def decode_replay_details(contents):
+def decode_replay_details(contents, fields=None, zero_copy=False):
     """Decodes and returns the game details from the contents byte string."""
-    decoder = VersionedDecoder(contents, typeinfos)
-    return decoder.instance(game_details_typeid)
+    decoder = VersionedDecoder(contents, typeinfos, zero_copy=zero_copy)
+    return decoder.instance(game_details_typeid, fields)
 
 
-def decode_replay_initdata(contents):
+def decode_replay_initdata(contents, fields=None, zero_copy=False):
     """Decodes and return the replay init data from the contents byte string."""
-    decoder = BitPackedDecoder(contents, typeinfos)
-    return decoder.instance(replay_initdata_typeid)
+    decoder = BitPackedDecoder(contents, typeinfos, zero_copy=zero_copy)
+    return decoder.instance(replay_initdata_typeid, fields)
 
 
 def decode_replay_attributes_events(contents):
     """Decodes and yields each attribute from the contents byte string."""
+    if AttributeTable.whole(contents):
+        return AttributeTable(contents).as_dict()
     buffer = BitPackedBuffer(contents, 'little')
     attributes = {}
     if not buffer.done():
@@ -480,6 +469,11 @@ def decode_replay_attributes_events(contents):
     return attributes
 
 
+def decode_replay_attributes_table(contents, columns='array'):
+    """Decodes the attributes from the contents byte string into an AttributeTable."""
+    return AttributeTable(contents, columns)
+
+
 def unit_tag(unitTagIndex, unitTagRecycle):
     return (unitTagIndex << 18) + unitTagRecycle
 
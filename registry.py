@@ -0,0 +1,174 @@
+#
+# Registry of the protocolNNNNN modules by base build.
+#
+# Many consecutive builds ship byte-identical protocol modules. The registry
+# fingerprints each build's schema and imports only the first module seen for
+# a fingerprint; later builds with the same schema share that module, and so
+# its typeinfos and compiled decoders. Lookups are safe from several threads;
+# the first one to ask for a schema loads it while the others wait.
+#
+# When cache_directory is set, from the HEROPROTOCOL_CACHE environment
+# variable by default, modules are loaded from their marshalled code stored
+# there instead of being compiled from source. This saves short-lived
+# processes that cannot write .pyc files next to the modules from compiling
+# each protocol module on every start. Only the module import is cached,
+# as a .pyc file would be: the decoders compiled from the typeinfos are
+# closures that cannot be marshalled, and are still built in memory on
+# first use in every process.
+
+import bisect
+import hashlib
+import imp
+import marshal
+import os
+import re
+import sys
+import threading
+
+cache_directory = os.environ.get('HEROPROTOCOL_CACHE') or None
+
+_directory = os.path.dirname(os.path.abspath(__file__))
+_package = __name__[:__name__.rfind('.') + 1]
+_module_re = re.compile(r'^protocol(\d+)\.py$')
+
+_lock = threading.RLock()
+_builds = None
+_fingerprints = {}  # base build -> schema fingerprint
+_schemas = {}  # schema fingerprint -> loaded protocol module
+_protocols = {}  # (base build, fallback) -> protocol module
+
+
+class UnsupportedBuildError(ImportError):
+    pass
+
+
+def get_protocol(base_build, fallback=False):
+    # Returns the protocol module for base_build, loading it on first use.
+    # Unknown builds raise UnsupportedBuildError, unless fallback is set and
+    # a closest_build is known; resolve_build tells which build is used.
+    protocol = _protocols.get((base_build, fallback))
+    if protocol is None:
+        with _lock:
+            protocol = _protocols.get((base_build, fallback))
+            if protocol is None:
+                protocol = load_protocol(resolve_build(base_build, fallback))
+                _protocols[(base_build, fallback)] = protocol
+    return protocol
+
+
+def resolve_build(base_build, fallback=False):
+    # Returns the build whose protocol module get_protocol uses for
+    # base_build: base_build itself when it has a module, otherwise with
+    # fallback its closest_build. Raises UnsupportedBuildError when there
+    # is none.
+    if base_build in protocol_builds():
+        return base_build
+    build = closest_build(base_build) if fallback else None
+    if build is None:
+        raise UnsupportedBuildError('Unsupported base build: %d' % base_build)
+    return build
+
+
+def closest_build(base_build):
+    # Returns the newest known build up to base_build, or None for builds
+    # older than any known one. Only the build numbers are compared; the
+    # schema of base_build is unknown, so its replays may not decode with
+    # the protocol of the build returned.
+    builds = protocol_builds()
+    index = bisect.bisect_right(builds, base_build)
+    if index == 0:
+        return None
+    return builds[index - 1]
+
+
+def preload_protocols(builds=None):
+    # Loads the protocols of builds, by default all known ones, so that
+    # worker processes forked afterwards share them without importing.
+    for build in protocol_builds() if builds is None else builds:
+        get_protocol(build)
+
+
+def protocol_builds():
+    # Returns the sorted base builds that have a protocol module, found from
+    # the module file names without importing them.
+    global _builds
+    if _builds is None:
+        matches = [_module_re.match(name) for name in os.listdir(_directory)]
+        _builds = sorted(int(match.group(1)) for match in matches if match)
+    return _builds
+
+
+def schema_fingerprint(build):
+    # Returns a hash of the build's typeinfos, event type maps and typeids.
+    # The protocol modules are generated, so it is read from the module
+    # source rather than by importing it.
+    fingerprint = _fingerprints.get(build)
+    if fingerprint is None:
+        if build not in protocol_builds():
+            raise UnsupportedBuildError('Unsupported base build: %d' % build)
+        with open(os.path.join(_directory, 'protocol%d.py' % build)) as f:
+            source = f.read()
+        start = source.index('typeinfos = [')
+        end = source.index('\ndef ', start)
+        fingerprint = hashlib.sha1(source[start:end]).hexdigest()
+        _fingerprints[build] = fingerprint
+    return fingerprint
+
+
+def load_protocol(build):
+    # Returns the protocol module for build, importing it the first time a
+    # build with its schema is seen.
+    with _lock:
+        fingerprint = schema_fingerprint(build)
+        protocol = _schemas.get(fingerprint)
+        if protocol is None:
+            name = _package + 'protocol%d' % build
+            if name not in sys.modules and cache_directory is not None:
+                protocol = _load_cached(name, build)
+            else:
+                protocol = __import__('protocol%d' % build, globals())
+            _schemas[fingerprint] = protocol
+    return protocol
+
+
+def _load_cached(name, build):
+    # Imports the protocol module from its code marshalled in the cache,
+    # compiling and storing it first when missing. Entries are keyed by the
+    # module source and Python version, so identical modules share one.
+    path = os.path.join(_directory, 'protocol%d.py' % build)
+    with open(path) as f:
+        source = f.read()
+    key = hashlib.sha1(imp.get_magic() + source).hexdigest()
+    cached = os.path.join(cache_directory, 'protocol-%s.marshal' % key)
+    try:
+        with open(cached, 'rb') as f:
+            code = marshal.loads(f.read())
+    except (IOError, EOFError, ValueError, TypeError):
+        code = compile(source, path, 'exec')
+        _write_cache(cached, marshal.dumps(code))
+    protocol = imp.new_module(name)
+    protocol.__file__ = path
+    sys.modules[name] = protocol
+    try:
+        exec code in protocol.__dict__
+    except:
+        del sys.modules[name]
+        raise
+    return protocol
+
+
+def _write_cache(cached, data):
+    # Writes a cache entry atomically; the cache is only an optimization, so
+    # an unwritable cache directory is ignored.
+    temporary = '%s.%d' % (cached, os.getpid())
+    try:
+        if not os.path.isdir(cache_directory):
+            os.makedirs(cache_directory)
+        with open(temporary, 'wb') as f:
+            f.write(data)
+        os.rename(temporary, cached)
+    except (IOError, OSError):
+        try:
+            os.remove(temporary)
+        except OSError:
+            pass
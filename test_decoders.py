@@ -0,0 +1,957 @@
+#
+# Checks the compiled decoders against a reference interpreter on random
+# encodings of every typeid of the oldest and newest protocols.
+#
+# The reference is the original decoder, which walks the typeinfos with a
+# getattr dispatch per value and reads the bits one byte at a time. Values
+# are encoded from the typeinfos; versioned encodings also get unknown
+# fields, unknown choice tags and reordered fields, and some encodings are
+# cut short. Both decoders must then return the same value or raise the
+# same error.
+#
+# Run from this directory with: python -m unittest test_decoders
+
+import array
+import mmap
+import random
+import struct
+import sys
+import threading
+import unittest
+
+from decoders import *
+import protocol29406
+import protocol40431
+
+PROTOCOLS = (protocol29406, protocol40431)
+
+
+class ReferenceBuffer:
+    def __init__(self, contents, endian='big'):
+        self._data = contents or []
+        self._used = 0
+        self._next = None
+        self._nextbits = 0
+        self._bigendian = (endian == 'big')
+
+    def done(self):
+        return self._nextbits == 0 and self._used >= len(self._data)
+
+    def used_bits(self):
+        return self._used * 8 - self._nextbits
+
+    def byte_align(self):
+        self._nextbits = 0
+
+    def read_aligned_bytes(self, bytes):
+        self.byte_align()
+        data = self._data[self._used:self._used + bytes]
+        self._used += bytes
+        if len(data) != bytes:
+            raise TruncatedError(self)
+        return data
+
+    def read_bits(self, bits):
+        result = 0
+        resultbits = 0
+        while resultbits != bits:
+            if self._nextbits == 0:
+                if self.done():
+                    raise TruncatedError(self)
+                self._next = ord(self._data[self._used])
+                self._used += 1
+                self._nextbits = 8
+            copybits = min(bits - resultbits, self._nextbits)
+            copy = (self._next & ((1 << copybits) - 1))
+            if self._bigendian:
+                result |= copy << (bits - resultbits - copybits)
+            else:
+                result |= copy << resultbits
+            self._next >>= copybits
+            self._nextbits -= copybits
+            resultbits += copybits
+        return result
+
+    def read_unaligned_bytes(self, bytes):
+        return ''.join([chr(self.read_bits(8)) for i in xrange(bytes)])
+
+
+class ReferenceBitPackedDecoder:
+    def __init__(self, contents, typeinfos):
+        self._buffer = ReferenceBuffer(contents)
+        self._typeinfos = typeinfos
+
+    def instance(self, typeid):
+        if typeid >= len(self._typeinfos):
+            raise CorruptedError(self)
+        typeinfo = self._typeinfos[typeid]
+        return getattr(self, typeinfo[0])(*typeinfo[1])
+
+    def _array(self, bounds, typeid):
+        length = self._int(bounds)
+        return [self.instance(typeid) for i in xrange(length)]
+
+    def _bitarray(self, bounds):
+        length = self._int(bounds)
+        return (length, self._buffer.read_bits(length))
+
+    def _blob(self, bounds):
+        length = self._int(bounds)
+        return self._buffer.read_aligned_bytes(length)
+
+    def _bool(self):
+        return self._int((0, 1)) != 0
+
+    def _choice(self, bounds, fields):
+        tag = self._int(bounds)
+        if tag not in fields:
+            raise CorruptedError(self)
+        field = fields[tag]
+        return {field[0]: self.instance(field[1])}
+
+    def _fourcc(self):
+        return self._buffer.read_unaligned_bytes(4)
+
+    def _int(self, bounds):
+        return bounds[0] + self._buffer.read_bits(bounds[1])
+
+    def _null(self):
+        return None
+
+    def _optional(self, typeid):
+        exists = self._bool()
+        return self.instance(typeid) if exists else None
+
+    def _real32(self):
+        return struct.unpack('>f', self._buffer.read_unaligned_bytes(4))
+
+    def _real64(self):
+        return struct.unpack('>d', self._buffer.read_unaligned_bytes(8))
+
+    def _struct(self, fields):
+        result = {}
+        for field in fields:
+            if field[0] == '__parent':
+                parent = self.instance(field[1])
+                if isinstance(parent, dict):
+                    result.update(parent)
+                elif len(fields) == 1:
+                    result = parent
+                else:
+                    result[field[0]] = parent
+            else:
+                result[field[0]] = self.instance(field[1])
+        return result
+
+
+class ReferenceVersionedDecoder:
+    def __init__(self, contents, typeinfos):
+        self._buffer = ReferenceBuffer(contents)
+        self._typeinfos = typeinfos
+
+    def instance(self, typeid):
+        if typeid >= len(self._typeinfos):
+            raise CorruptedError(self)
+        typeinfo = self._typeinfos[typeid]
+        return getattr(self, typeinfo[0])(*typeinfo[1])
+
+    def _expect_skip(self, expected):
+        if self._buffer.read_bits(8) != expected:
+            raise CorruptedError(self)
+
+    def _vint(self):
+        b = self._buffer.read_bits(8)
+        negative = b & 1
+        result = (b >> 1) & 0x3f
+        bits = 6
+        while (b & 0x80) != 0:
+            b = self._buffer.read_bits(8)
+            result |= (b & 0x7f) << bits
+            bits += 7
+        return -result if negative else result
+
+    def _array(self, bounds, typeid):
+        self._expect_skip(0)
+        length = self._vint()
+        return [self.instance(typeid) for i in xrange(length)]
+
+    def _bitarray(self, bounds):
+        self._expect_skip(1)
+        length = self._vint()
+        return (length, self._buffer.read_aligned_bytes((length + 7) / 8))
+
+    def _blob(self, bounds):
+        self._expect_skip(2)
+        length = self._vint()
+        return self._buffer.read_aligned_bytes(length)
+
+    def _bool(self):
+        self._expect_skip(6)
+        return self._buffer.read_bits(8) != 0
+
+    def _choice(self, bounds, fields):
+        self._expect_skip(3)
+        tag = self._vint()
+        if tag not in fields:
+            self._skip_instance()
+            return {}
+        field = fields[tag]
+        return {field[0]: self.instance(field[1])}
+
+    def _fourcc(self):
+        self._expect_skip(7)
+        return self._buffer.read_aligned_bytes(4)
+
+    def _int(self, bounds):
+        self._expect_skip(9)
+        return self._vint()
+
+    def _null(self):
+        return None
+
+    def _optional(self, typeid):
+        self._expect_skip(4)
+        exists = self._buffer.read_bits(8) != 0
+        return self.instance(typeid) if exists else None
+
+    def _real32(self):
+        self._expect_skip(7)
+        return struct.unpack('>f', self._buffer.read_aligned_bytes(4))
+
+    def _real64(self):
+        self._expect_skip(8)
+        return struct.unpack('>d', self._buffer.read_aligned_bytes(8))
+
+    def _struct(self, fields):
+        self._expect_skip(5)
+        result = {}
+        length = self._vint()
+        for i in xrange(length):
+            tag = self._vint()
+            field = next((f for f in fields if f[2] == tag), None)
+            if field:
+                if field[0] == '__parent':
+                    parent = self.instance(field[1])
+                    if isinstance(parent, dict):
+                        result.update(parent)
+                    elif len(fields) == 1:
+                        result = parent
+                    else:
+                        result[field[0]] = parent
+                else:
+                    result[field[0]] = self.instance(field[1])
+            else:
+                self._skip_instance()
+        return result
+
+    def _skip_instance(self):
+        skip = self._buffer.read_bits(8)
+        if skip == 0:  # array
+            for i in xrange(self._vint()):
+                self._skip_instance()
+        elif skip == 1:  # bitblob
+            self._buffer.read_aligned_bytes((self._vint() + 7) / 8)
+        elif skip == 2:  # blob
+            self._buffer.read_aligned_bytes(self._vint())
+        elif skip == 3:  # choice
+            self._vint()
+            self._skip_instance()
+        elif skip == 4:  # optional
+            if self._buffer.read_bits(8) != 0:
+                self._skip_instance()
+        elif skip == 5:  # struct
+            for i in xrange(self._vint()):
+                self._vint()
+                self._skip_instance()
+        elif skip == 6:  # u8
+            self._buffer.read_aligned_bytes(1)
+        elif skip == 7:  # u32
+            self._buffer.read_aligned_bytes(4)
+        elif skip == 8:  # u64
+            self._buffer.read_aligned_bytes(8)
+        elif skip == 9:  # vint
+            self._vint()
+
+
+class BitPackedEncoder:
+    # Writes random values of typeinfos in the bit-packed format, big
+    # endian, with lengths kept short and nesting bounded.
+    def __init__(self, typeinfos, rng):
+        self._typeinfos = typeinfos
+        self._rng = rng
+        self._bits = []
+        self._count = 0
+        self._depth = 0
+
+    def getvalue(self):
+        self.byte_align()
+        bits = ''.join(self._bits)
+        return ''.join(chr(int(bits[i:i + 8][::-1], 2)) for i in xrange(0, len(bits), 8))
+
+    def byte_align(self):
+        # bytes are filled from their lowest bit, so the bit string holds
+        # each byte least significant bit first
+        self._bits.append('0' * (-self._count % 8))
+        self._count += -self._count % 8
+
+    def write_bits(self, value, bits):
+        # a value's bits go into the stream most significant first, but
+        # within each byte they fill the lowest free bits
+        while bits:
+            take = min(8 - self._count % 8, bits)
+            chunk = (value >> (bits - take)) & ((1 << take) - 1)
+            self._bits.append(''.join(str(chunk >> i & 1) for i in xrange(take)))
+            self._count += take
+            bits -= take
+
+    def write_bytes(self, data):
+        for c in data:
+            self.write_bits(ord(c), 8)
+
+    def instance(self, typeid):
+        kind, args = self._typeinfos[typeid]
+        self._depth += 1
+        getattr(self, kind)(*args)
+        self._depth -= 1
+
+    def _length(self, bounds):
+        limit = 4 if self._depth < 5 else 0
+        length = self._rng.randint(bounds[0], min(bounds[0] + (1 << bounds[1]) - 1, bounds[0] + limit))
+        self.write_bits(length - bounds[0], bounds[1])
+        return length
+
+    def _array(self, bounds, typeid):
+        for i in xrange(self._length(bounds)):
+            self.instance(typeid)
+
+    def _bitarray(self, bounds):
+        length = self._length(bounds)
+        self.write_bits(self._rng.getrandbits(length) if length else 0, length)
+
+    def _blob(self, bounds):
+        length = self._length(bounds)
+        self.byte_align()
+        self.write_bytes(_random_bytes(self._rng, length))
+
+    def _bool(self):
+        self.write_bits(self._rng.randrange(2), 1)
+
+    def _choice(self, bounds, fields):
+        tag = self._rng.choice(sorted(fields))
+        self.write_bits(tag - bounds[0], bounds[1])
+        self.instance(fields[tag][1])
+
+    def _fourcc(self):
+        self.write_bytes(_random_bytes(self._rng, 4))
+
+    def _int(self, bounds):
+        self.write_bits(_random_bits(self._rng, bounds[1]), bounds[1])
+
+    def _null(self):
+        pass
+
+    def _optional(self, typeid):
+        exists = self._rng.randrange(2) if self._depth < 5 else 0
+        self.write_bits(exists, 1)
+        if exists:
+            self.instance(typeid)
+
+    def _real32(self):
+        self.write_bytes(struct.pack('>f', self._rng.random()))
+
+    def _real64(self):
+        self.write_bytes(struct.pack('>d', self._rng.random()))
+
+    def _struct(self, fields):
+        for field in fields:
+            self.instance(field[1])
+
+
+class VersionedEncoder:
+    # Writes random values of typeinfos in the versioned format, sometimes
+    # with unknown struct fields and choice tags, dropped fields and fields
+    # out of order.
+    def __init__(self, typeinfos, rng):
+        self._typeinfos = typeinfos
+        self._rng = rng
+        self._out = []
+        self._depth = 0
+
+    def getvalue(self):
+        return ''.join(self._out)
+
+    def vint(self, value):
+        negative = value < 0
+        value = abs(value)
+        b = (value & 0x3f) << 1 | negative
+        value >>= 6
+        while value:
+            self._out.append(chr(b | 0x80))
+            b = value & 0x7f
+            value >>= 7
+        self._out.append(chr(b))
+
+    def instance(self, typeid):
+        kind, args = self._typeinfos[typeid]
+        self._depth += 1
+        getattr(self, kind)(*args)
+        self._depth -= 1
+
+    def unknown(self, depth=0):
+        # any tagged value, for the fields and choices the decoder skips
+        skip = self._rng.choice([2, 6, 7, 8, 9] if depth > 2 else range(10))
+        self._out.append(chr(skip))
+        if skip in (0, 5):
+            length = self._rng.randrange(3)
+            self.vint(length)
+            for i in xrange(length):
+                if skip == 5:
+                    self.vint(self._rng.randrange(100))
+                self.unknown(depth + 1)
+        elif skip in (1, 2):
+            length = self._rng.randrange(20)
+            self.vint(length)
+            self._out.append(_random_bytes(self._rng, (length + 7) / 8 if skip == 1 else length))
+        elif skip == 3:
+            self.vint(self._rng.randrange(100))
+            self.unknown(depth + 1)
+        elif skip == 4:
+            exists = self._rng.randrange(2)
+            self._out.append(chr(exists))
+            if exists:
+                self.unknown(depth + 1)
+        elif skip in (6, 7, 8):
+            self._out.append(_random_bytes(self._rng, {6: 1, 7: 4, 8: 8}[skip]))
+        else:
+            self.vint(self._rng.randint(-10 ** 12, 10 ** 12))
+
+    def _length(self, bounds):
+        limit = 4 if self._depth < 5 else 0
+        return self._rng.randint(bounds[0], min(bounds[0] + (1 << bounds[1]) - 1, bounds[0] + limit))
+
+    def _array(self, bounds, typeid):
+        self._out.append('\x00')
+        length = self._length(bounds)
+        self.vint(length)
+        for i in xrange(length):
+            self.instance(typeid)
+
+    def _bitarray(self, bounds):
+        self._out.append('\x01')
+        length = self._length(bounds)
+        self.vint(length)
+        self._out.append(_random_bytes(self._rng, (length + 7) / 8))
+
+    def _blob(self, bounds):
+        self._out.append('\x02')
+        length = self._length(bounds)
+        self.vint(length)
+        self._out.append(_random_bytes(self._rng, length))
+
+    def _bool(self):
+        self._out.append('\x06' + chr(self._rng.randrange(2)))
+
+    def _choice(self, bounds, fields):
+        self._out.append('\x03')
+        if self._rng.random() < 0.1:
+            self.vint(1000)
+            self.unknown()
+            return
+        tag = self._rng.choice(sorted(fields))
+        self.vint(tag)
+        self.instance(fields[tag][1])
+
+    def _fourcc(self):
+        self._out.append('\x07' + _random_bytes(self._rng, 4))
+
+    def _int(self, bounds):
+        self._out.append('\x09')
+        self.vint(bounds[0] + _random_bits(self._rng, bounds[1]))
+
+    def _null(self):
+        pass
+
+    def _optional(self, typeid):
+        exists = self._rng.randrange(2) if self._depth < 5 else 0
+        self._out.append('\x04' + chr(exists))
+        if exists:
+            self.instance(typeid)
+
+    def _real32(self):
+        self._out.append('\x07' + struct.pack('>f', self._rng.random()))
+
+    def _real64(self):
+        self._out.append('\x08' + struct.pack('>d', self._rng.random()))
+
+    def _struct(self, fields):
+        self._out.append('\x05')
+        items = [field for field in fields if self._rng.random() > 0.05]
+        if self._rng.random() < 0.1:
+            items.insert(self._rng.randrange(len(items) + 1), None)
+        if self._rng.random() < 0.1:
+            self._rng.shuffle(items)
+        self.vint(len(items))
+        for field in items:
+            if field is None:
+                self.vint(9999)
+                self.unknown()
+            else:
+                self.vint(field[2])
+                self.instance(field[1])
+
+
+def _random_bits(rng, bits):
+    # favours the extremes, where bit handling goes wrong
+    choice = rng.random()
+    if bits == 0 or choice < 0.2:
+        return 0
+    if choice < 0.4:
+        return (1 << bits) - 1
+    return rng.getrandbits(bits)
+
+
+def _random_bytes(rng, size):
+    return ''.join(chr(rng.randrange(256)) for i in xrange(size))
+
+
+def _plain(value, kinds=None):
+    # The value with blob views and int arrays turned back into the strings
+    # and lists of a default decode. kinds counts the types replaced.
+    if isinstance(value, (memoryview, buffer, array.array)):
+        if kinds is not None:
+            kinds[type(value)] = kinds.get(type(value), 0) + 1
+        if isinstance(value, memoryview):
+            return value.tobytes()
+        return value.tolist() if isinstance(value, array.array) else str(value)
+    if isinstance(value, (dict, Record)):
+        return dict((key, _plain(item, kinds)) for key, item in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return type(value)(_plain(item, kinds) for item in value)
+    return value
+
+
+def _outcome(decode):
+    # The decoded value, or the type of the error raised.
+    try:
+        return decode()
+    except (TruncatedError, CorruptedError) as e:
+        return type(e)
+
+
+class BufferTest(unittest.TestCase):
+    def test_bitpacked(self):
+        # random sequences of reads read the same values as the reference,
+        # stop at the same position and raise the same errors
+        for buffer_class in (BitPackedBuffer, WordBitPackedBuffer):
+            self.check_bitpacked(buffer_class)
+
+    def check_bitpacked(self, buffer_class):
+        rng = random.Random(0)
+        for endian in ('big', 'little'):
+            for i in xrange(2000):
+                contents = _random_bytes(rng, rng.randrange(24))
+                reference = ReferenceBuffer(contents, endian)
+                buffer = buffer_class(contents, endian)
+                for j in xrange(12):
+                    operation = rng.randrange(5)
+                    if operation == 0:
+                        bits = rng.choice([0, 1, 3, 7, 8, 9, 16, 31, 32, 33, 64, rng.randrange(80)])
+                        expected = _outcome(lambda: reference.read_bits(bits))
+                        result = _outcome(lambda: buffer.read_bits(bits))
+                    elif operation == 1:
+                        expected = reference.byte_align()
+                        result = buffer.byte_align()
+                    elif operation == 2:
+                        size = rng.randrange(6)
+                        expected = _outcome(lambda: reference.read_aligned_bytes(size))
+                        result = _outcome(lambda: buffer.read_aligned_bytes(size))
+                    elif operation == 3:
+                        bits = rng.randrange(40)
+                        expected = _outcome(lambda: (reference.read_bits(bits), None)[1])
+                        result = _outcome(lambda: buffer.skip_bits(bits))
+                    else:
+                        bits = rng.choice([1, 5, 8, 16, 32, 64])
+                        count = rng.randrange(5)
+                        expected = _outcome(lambda: [reference.read_bits(bits) for k in xrange(count)])
+                        result = _outcome(lambda: buffer.read_bits_array(bits, count))
+                    self.assertEqual(result, expected, (buffer_class.__name__, endian, contents, operation))
+                    if isinstance(expected, type):
+                        break
+                    self.assertEqual(buffer.used_bits(), reference.used_bits(), (buffer_class.__name__, endian, contents, operation))
+                    self.assertEqual(buffer.done(), reference.done())
+
+
+class DecoderTest(unittest.TestCase):
+    encodings = 6
+
+    def encodings_of(self, encoder_class, protocol, typeid, rng):
+        for i in xrange(self.encodings):
+            encoder = encoder_class(protocol.typeinfos, rng)
+            encoder.instance(typeid)
+            contents = encoder.getvalue()
+            if contents and rng.random() < 0.2:
+                contents = contents[:rng.randrange(len(contents))]
+            yield contents
+
+    def test_bitpacked(self):
+        rng = random.Random(1)
+        for protocol in PROTOCOLS:
+            typeinfos = protocol.typeinfos
+            for typeid in xrange(len(typeinfos)):
+                for contents in self.encodings_of(BitPackedEncoder, protocol, typeid, rng):
+                    expected = _outcome(lambda: ReferenceBitPackedDecoder(contents, typeinfos).instance(typeid))
+                    decoder = BitPackedDecoder(contents, typeinfos)
+                    self.assertEqual(_outcome(lambda: decoder.instance(typeid)), expected,
+                                     (protocol.__name__, typeid, contents))
+
+    def test_versioned(self):
+        rng = random.Random(2)
+        for protocol in PROTOCOLS:
+            typeinfos = protocol.typeinfos
+            for typeid in xrange(len(typeinfos)):
+                for contents in self.encodings_of(VersionedEncoder, protocol, typeid, rng):
+                    expected = _outcome(lambda: ReferenceVersionedDecoder(contents, typeinfos).instance(typeid))
+                    for inline in ((), (typeid,)):
+                        decoder = VersionedDecoder(contents, typeinfos, inline=inline)
+                        self.assertEqual(_outcome(lambda: decoder.instance(typeid)), expected,
+                                         (protocol.__name__, typeid, contents))
+
+    def test_skip(self):
+        # skipping a value consumes the bits that decoding it does
+        rng = random.Random(3)
+        for protocol in PROTOCOLS:
+            typeinfos = protocol.typeinfos
+            for typeid in xrange(len(typeinfos)):
+                for encoder_class, decoder_class in ((BitPackedEncoder, BitPackedDecoder),
+                                                     (VersionedEncoder, VersionedDecoder)):
+                    for contents in self.encodings_of(encoder_class, protocol, typeid, rng):
+                        decoder = decoder_class(contents, typeinfos)
+                        expected = _outcome(lambda: decoder.instance(typeid))
+                        if isinstance(expected, type):
+                            continue
+                        used_bits = decoder.used_bits()
+                        decoder = decoder_class(contents, typeinfos)
+                        decoder.skip(typeid)
+                        self.assertEqual(decoder.used_bits(), used_bits, (protocol.__name__, typeid, contents))
+
+
+    def test_project(self):
+        rng = random.Random(7)
+        for protocol in PROTOCOLS:
+            encoder = VersionedEncoder(protocol.typeinfos, rng)
+            encoder.instance(protocol.game_details_typeid)
+            contents = encoder.getvalue()
+            details = protocol.decode_replay_details(contents)
+            projected = protocol.decode_replay_details(contents, ['m_title', 'm_playerList.m_name'])
+            self.assertEqual(projected.get('m_title'), details.get('m_title'))
+            players = details.get('m_playerList')
+            if players is not None:
+                players = [dict((k, v) for k, v in player.iteritems() if k == 'm_name') for player in players]
+            self.assertEqual(projected.get('m_playerList'), players)
+            for fields in ('m_title', ['m_titel'], ['m_playerList.m_nme'], ['m_title.m_name']):
+                self.assertRaises(ValueError, protocol.decode_replay_details, contents, fields)
+
+
+class EventStreamTest(unittest.TestCase):
+    events = 150
+
+    def game_stream(self, protocol, event_types, eventid_typeid, rng):
+        encoder = BitPackedEncoder(protocol.typeinfos, rng)
+        eventid_bits = protocol.typeinfos[eventid_typeid][1][0][1]
+        for i in xrange(self.events):
+            encoder.instance(protocol.svaruint32_typeid)
+            encoder.instance(protocol.replay_userid_typeid)
+            eventid = rng.choice(sorted(event_types))
+            encoder.write_bits(eventid, eventid_bits)
+            encoder.instance(event_types[eventid][0])
+            encoder.byte_align()
+        return encoder.getvalue()
+
+    def tracker_stream(self, protocol, rng):
+        encoder = VersionedEncoder(protocol.typeinfos, rng)
+        for i in xrange(self.events):
+            encoder.instance(protocol.svaruint32_typeid)
+            eventid = rng.choice(sorted(protocol.tracker_event_types))
+            encoder._out.append('\x09')
+            encoder.vint(eventid)
+            encoder.instance(protocol.tracker_event_types[eventid][0])
+        return encoder.getvalue()
+
+    def reference_events(self, decoder, protocol, eventid_typeid, event_types, decode_user_id):
+        # the original event loop
+        events = []
+        gameloop = 0
+        while not decoder._buffer.done():
+            start_bits = decoder._buffer.used_bits()
+            gameloop += (decoder.instance(protocol.svaruint32_typeid).values() or [0])[0]
+            if decode_user_id:
+                userid = decoder.instance(protocol.replay_userid_typeid)
+            eventid = decoder.instance(eventid_typeid)
+            typeid, typename = event_types[eventid]
+            event = decoder.instance(typeid)
+            event['_event'] = typename
+            event['_eventid'] = eventid
+            event['_gameloop'] = gameloop
+            if decode_user_id:
+                event['_userid'] = userid
+            decoder._buffer.byte_align()
+            event['_bits'] = decoder._buffer.used_bits() - start_bits
+            events.append(event)
+        return events
+
+    def streams(self, rng):
+        for protocol in PROTOCOLS:
+            for name in ('game', 'message'):
+                eventid_typeid = getattr(protocol, '%s_eventid_typeid' % name)
+                event_types = getattr(protocol, '%s_event_types' % name)
+                contents = self.game_stream(protocol, event_types, eventid_typeid, rng)
+                expected = self.reference_events(ReferenceBitPackedDecoder(contents, protocol.typeinfos),
+                                                 protocol, eventid_typeid, event_types, True)
+                yield protocol, name, contents, expected
+            contents = self.tracker_stream(protocol, rng)
+            expected = self.reference_events(ReferenceVersionedDecoder(contents, protocol.typeinfos), protocol,
+                                             protocol.tracker_eventid_typeid, protocol.tracker_event_types, False)
+            yield protocol, 'tracker', contents, expected
+
+    def test_decode(self):
+        for protocol, name, contents, expected in self.streams(random.Random(4)):
+            decode = getattr(protocol, 'decode_replay_%s_events' % name)
+            self.assertEqual(list(decode(contents)), expected, (protocol.__name__, name))
+            chunks = (contents[i:i + 100] for i in xrange(0, len(contents), 100))
+            self.assertEqual(list(decode(chunks)), expected, (protocol.__name__, name))
+            if name == 'tracker':
+                self.assertRaises(ValueError, list, decode(contents, buffer_class=WordBitPackedBuffer))
+            else:
+                self.assertEqual(list(decode(contents, buffer_class=WordBitPackedBuffer)), expected,
+                                 (protocol.__name__, name))
+
+    def test_fields(self):
+        for protocol, name, contents, expected in self.streams(random.Random(8)):
+            decode = getattr(protocol, 'decode_replay_%s_events' % name)
+            self.assertRaises(ValueError, list, decode(contents, fields={'NNet.Game.SNoSuchEvent': ['m_x']}))
+            for event_filter in (['NNet.Game.STypoEvent'], [expected[0]['_event'], 1000], expected[0]['_event']):
+                self.assertRaises(ValueError, list, decode(contents, event_filter=event_filter))
+
+    def test_event_filter(self):
+        rng = random.Random(10)
+        for protocol, name, contents, expected in self.streams(rng):
+            decode = getattr(protocol, 'decode_replay_%s_events' % name)
+            event_types = getattr(protocol, '%s_event_types' % name)
+            present = sorted(set(event['_eventid'] for event in expected))
+            eventids = rng.sample(present, 2) + [rng.choice(sorted(event_types))]
+            # selected by name and by id
+            event_filter = [event_types[eventids[0]][1], eventids[1], eventids[2]]
+            filtered = [event for event in expected if event['_eventid'] in eventids]
+            self.assertEqual(list(decode(contents, event_filter=event_filter)), filtered,
+                             (protocol.__name__, name, eventids))
+
+    def test_zero_copy(self):
+        kinds = {}
+        for protocol, name, contents, expected in self.streams(random.Random(11)):
+            decode = getattr(protocol, 'decode_replay_%s_events' % name)
+            mapped = mmap.mmap(-1, len(contents))
+            mapped.write(contents)
+            for data in (contents, bytearray(contents), memoryview(contents), mapped):
+                self.assertEqual(list(decode(data)), expected, (protocol.__name__, name, type(data)))
+                events = list(decode(data, zero_copy=True))
+                self.assertEqual([_plain(event, kinds) for event in events], expected,
+                                 (protocol.__name__, name, type(data)))
+            mapped.close()
+        # blobs came back as views, of the mmap through the buffer interface
+        self.assertTrue(kinds.get(memoryview) and kinds.get(buffer), kinds)
+
+    def test_records(self):
+        records = 0
+        for protocol, name, contents, expected in self.streams(random.Random(12)):
+            decode = getattr(protocol, 'decode_replay_%s_events' % name)
+            events = list(decode(contents, records=True))
+            self.assertEqual(events, expected, (protocol.__name__, name))
+            self.assertEqual([_plain(event) for event in events], expected, (protocol.__name__, name))
+            records += sum(1 for event in events if isinstance(event, Record))
+        self.assertTrue(records)
+
+    def test_int_arrays(self):
+        kinds = {}
+        for protocol, name, contents, expected in self.streams(random.Random(13)):
+            decode = getattr(protocol, 'decode_replay_%s_events' % name)
+            events = list(decode(contents, int_arrays='array'))
+            self.assertEqual([_plain(event, kinds) for event in events], expected, (protocol.__name__, name))
+        self.assertTrue(kinds.get(array.array), kinds)
+        self.assertRaises(ValueError, list, decode(contents, int_arrays='tuple'))
+
+    def test_window(self):
+        rng = random.Random(5)
+        for protocol, name, contents, expected in self.streams(rng):
+            decode = getattr(protocol, 'decode_replay_%s_events' % name)
+            gameloops = [event['_gameloop'] for event in expected]
+            index = getattr(protocol, 'index_replay_%s_events' % name)(contents, gameloops[-1] / 10 + 1)
+            for i in xrange(5):
+                start, end = sorted(rng.choice(gameloops) for j in xrange(2))
+                window = [event for event in expected if start <= event['_gameloop'] <= end]
+                self.assertEqual(list(decode(contents, start_gameloop=start, end_gameloop=end, index=index)),
+                                 window, (protocol.__name__, name, start, end))
+
+    def test_workers(self):
+        import multiprocessing
+        rng = random.Random(14)
+        pool = multiprocessing.Pool(2)
+        try:
+            for protocol, name, contents, expected in self.streams(rng):
+                decode = getattr(protocol, 'decode_replay_%s_events' % name)
+                gameloops = [event['_gameloop'] for event in expected]
+                index = getattr(protocol, 'index_replay_%s_events' % name)(contents, gameloops[-1] / 10 + 1)
+                self.assertEqual(list(decode(contents, index=index, workers=pool)), expected,
+                                 (protocol.__name__, name))
+                start, end = sorted(rng.choice(gameloops) for j in xrange(2))
+                window = [event for event in expected if start <= event['_gameloop'] <= end]
+                self.assertEqual(list(decode(contents, start_gameloop=start, end_gameloop=end, index=index,
+                                             workers=pool)), window, (protocol.__name__, name, start, end))
+                for options in ({'records': True}, {'zero_copy': True}):
+                    self.assertRaises(ValueError, list, decode(contents, index=index, workers=pool, **options))
+                self.assertRaises(ValueError, list, decode(contents, workers=pool))
+                chunks = (contents[i:i + 100] for i in xrange(0, len(contents), 100))
+                self.assertRaises(ValueError, list, decode(chunks, index=index, workers=pool))
+        finally:
+            pool.terminate()
+        # a worker count starts a pool of its own
+        self.assertEqual(list(decode(contents, index=index, workers=2)), expected)
+
+    def test_scan(self):
+        for protocol, name, contents, expected in self.streams(random.Random(6)):
+            stats = getattr(protocol, 'scan_replay_%s_events' % name)(contents)
+            counts = {}
+            for event in expected:
+                counts[event['_event']] = counts.get(event['_event'], 0) + 1
+            self.assertEqual(stats['event_counts'], counts)
+            self.assertEqual(sum(stats['event_bytes'].values()), len(contents))
+            self.assertEqual(stats['last_gameloop'], expected[-1]['_gameloop'])
+
+
+def reference_attributes(contents):
+    # the original bit reader loop of decode_replay_attributes_events
+    buffer = ReferenceBuffer(contents, 'little')
+    attributes = {}
+    if not buffer.done():
+        attributes['source'] = buffer.read_bits(8)
+        attributes['mapNamespace'] = buffer.read_bits(32)
+        count = buffer.read_bits(32)
+        attributes['scopes'] = {}
+        while not buffer.done():
+            value = {}
+            value['namespace'] = buffer.read_bits(32)
+            value['attrid'] = attrid = buffer.read_bits(32)
+            scope = buffer.read_bits(8)
+            value['value'] = buffer.read_aligned_bytes(4)[::-1].strip('\x00')
+            attributes['scopes'].setdefault(scope, {}).setdefault(attrid, []).append(value)
+    return attributes
+
+
+class AttributeTableTest(unittest.TestCase):
+    def attributes(self, rng, count):
+        # few distinct keys, so that keys repeat
+        records = [(rng.choice([0, 1, 999, 0xffffffff]), rng.choice([500, 4000, 0x80000000, 0xffffffff]),
+                    rng.choice([1, 16]), rng.choice(['', '\x00\x00aB', 'Hmn\x00', _random_bytes(rng, 4)]))
+                   for i in xrange(count)]
+        contents = struct.pack('<BII', rng.randrange(256), rng.getrandbits(32), count)
+        contents += ''.join(struct.pack('<IIB4s', *record) for record in records)
+        return contents, records
+
+    def assert_ints(self, value):
+        if isinstance(value, dict):
+            for key, item in value.iteritems():
+                self.assert_ints(key)
+                self.assert_ints(item)
+        elif isinstance(value, list):
+            for item in value:
+                self.assert_ints(item)
+        elif not isinstance(value, str):
+            self.assertIs(type(value), int)
+
+    def test_as_dict(self):
+        rng = random.Random(15)
+        for i in xrange(200):
+            contents, records = self.attributes(rng, rng.randrange(30))
+            expected = reference_attributes(contents)
+            attributes = AttributeTable(contents).as_dict()
+            self.assertEqual(attributes, expected)
+            self.assert_ints(attributes)
+            self.assertEqual(protocol40431.decode_replay_attributes_events(contents), expected)
+
+    def test_lookup(self):
+        rng = random.Random(16)
+        for i in xrange(100):
+            contents, records = self.attributes(rng, rng.randrange(30))
+            table = AttributeTable(contents)
+            self.assertEqual(len(table), len(records))
+            for namespace, attrid, scope, value in records:
+                rows = [j for j, record in enumerate(records) if record[1:3] == (attrid, scope)]
+                self.assertEqual(table.rows(scope, attrid), rows)
+                self.assertEqual(table.lookup(scope, attrid), [records[j][3][::-1].strip('\x00') for j in rows])
+                self.assert_ints([table.row(j) for j in rows])
+            self.assertEqual(table.rows(2, 500), [])
+
+    def test_truncated(self):
+        # streams that are not a whole number of records fall back to the
+        # bit reader and fail, or not, as the original did
+        rng = random.Random(17)
+        for i in xrange(100):
+            contents, records = self.attributes(rng, rng.randrange(1, 5))
+            contents = contents[:rng.randrange(len(contents))]
+            expected = _outcome(lambda: reference_attributes(contents))
+            self.assertEqual(_outcome(lambda: protocol40431.decode_replay_attributes_events(contents)), expected,
+                             contents)
+            if not AttributeTable.whole(contents):
+                self.assertRaises(TruncatedError, AttributeTable, contents)
+
+
+class ThreadTest(unittest.TestCase):
+    def test_lazy_compile(self):
+        # threads that compile the same skips and projections at once all get
+        # complete decoders
+        rng = random.Random(9)
+        typeinfos = protocol40431.typeinfos
+        values = []
+        for typeid in xrange(len(typeinfos)):
+            encoder = BitPackedEncoder(typeinfos, rng)
+            encoder.instance(typeid)
+            contents = encoder.getvalue()
+            decoder = BitPackedDecoder(contents, typeinfos)
+            value = decoder.instance(typeid)
+            fields = [value.keys()[0]] if isinstance(value, dict) and value else None
+            values.append((typeid, contents, decoder.used_bits(), fields, value))
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            for attempt in xrange(3):
+                compiler = BitPackedCompiler(typeinfos)
+                compiler.compile()
+                start = threading.Event()
+                failures = []
+                def run(values):
+                    start.wait()
+                    try:
+                        for typeid, contents, used_bits, fields, value in values:
+                            buffer = BitPackedBuffer(contents)
+                            compiler.skip(typeid)(buffer)
+                            if buffer.used_bits() != used_bits:
+                                failures.append(('skip', typeid))
+                            if fields is not None:
+                                projected = compiler.project(typeid, fields)(BitPackedBuffer(contents))
+                                if projected != dict((name, value[name]) for name in fields):
+                                    failures.append(('project', typeid))
+                    except Exception as e:
+                        failures.append(e)
+                threads = [threading.Thread(target=run, args=(rng.sample(values, len(values)),))
+                           for i in xrange(8)]
+                for thread in threads:
+                    thread.start()
+                start.set()
+                for thread in threads:
+                    thread.join()
+                self.assertEqual(failures, [])
+        finally:
+            sys.setcheckinterval(interval)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+#
+# Checks the protocol registry's build lookup and module sharing.
+#
+# Run from this directory with: python -m unittest test_registry
+#
+
+import threading
+import unittest
+
+import registry
+
+
+class RegistryTest(unittest.TestCase):
+    def test_protocol_builds(self):
+        builds = registry.protocol_builds()
+        self.assertEqual(builds, sorted(builds))
+        self.assertEqual(builds[0], 29406)
+        self.assertIn(40431, builds)
+
+    def test_closest_build(self):
+        builds = registry.protocol_builds()
+        self.assertEqual(registry.closest_build(builds[0] - 1), None)
+        self.assertEqual(registry.closest_build(builds[0]), builds[0])
+        self.assertEqual(registry.closest_build(40335), 40322)
+        self.assertEqual(registry.closest_build(40336), 40336)
+        self.assertEqual(registry.closest_build(builds[-1] + 1000), builds[-1])
+
+    def test_shared_schema(self):
+        # builds with one schema share their module, and so its compiled
+        # decoders; builds with another schema do not
+        self.assertEqual(registry.schema_fingerprint(40336), registry.schema_fingerprint(40431))
+        protocol = registry.get_protocol(40336)
+        self.assertIs(registry.get_protocol(40431), protocol)
+        self.assertIs(registry.load_protocol(40431), protocol)
+        self.assertNotEqual(registry.schema_fingerprint(29406), registry.schema_fingerprint(40431))
+        self.assertIsNot(registry.get_protocol(29406), protocol)
+        self.assertEqual(registry.get_protocol(29406).__name__, 'protocol29406')
+
+    def test_resolve_build(self):
+        builds = registry.protocol_builds()
+        self.assertEqual(registry.resolve_build(40431), 40431)
+        self.assertEqual(registry.resolve_build(40431, fallback=True), 40431)
+        self.assertEqual(registry.resolve_build(40335, fallback=True), 40322)
+        self.assertEqual(registry.resolve_build(builds[-1] + 1000, fallback=True), builds[-1])
+        self.assertRaises(registry.UnsupportedBuildError, registry.resolve_build, 40335)
+        self.assertRaises(registry.UnsupportedBuildError, registry.resolve_build, builds[0] - 1, True)
+
+    def test_get_protocol(self):
+        builds = registry.protocol_builds()
+        self.assertIs(registry.get_protocol(40335, fallback=True), registry.get_protocol(40322))
+        self.assertIs(registry.get_protocol(builds[-1] + 1000, True), registry.get_protocol(builds[-1]))
+        for build, fallback in ((40335, False), (builds[0] - 1, True)):
+            self.assertRaises(registry.UnsupportedBuildError, registry.get_protocol, build, fallback)
+        # callers that catch the ImportError of a failed import still work
+        self.assertTrue(issubclass(registry.UnsupportedBuildError, ImportError))
+
+    def test_threads(self):
+        # threads asking for builds at once all get the one shared module
+        builds = [30414, 30509, 30829, 30948, 31090] * 4
+        protocols = []
+        start = threading.Event()
+        def run(build):
+            start.wait()
+            protocols.append(registry.get_protocol(build))
+        threads = [threading.Thread(target=run, args=(build,)) for build in builds]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(protocols), len(builds))
+        self.assertTrue(all(protocol is protocols[0] for protocol in protocols))
+
+
+if __name__ == '__main__':
+    unittest.main()